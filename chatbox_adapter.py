@@ -1,7 +1,13 @@
 import asyncio
 import json
+import os
+import socket
+import stat
+import sys
+import tempfile
 import time
 import uuid
+from collections import OrderedDict
 
 try:
     from aiohttp import web
@@ -33,11 +39,37 @@ from astrbot.core.platform.astr_message_event import MessageSesion
 
 # 导入我们的自定义事件
 from .chatbox_event import ChatboxEvent
+from .chatbox_fingerprint import ConversationFingerprintIndex, message_digests
+from .chatbox_protocol import (
+    UploadTooLarge,
+    collect_non_stream,
+    compact_item,
+    compact_request,
+    encode_frame,
+    expand_request,
+    format_as_openai_chunk,
+    format_as_openai_response,
+    iter_jsonl_lines,
+    pump_stream,
+    read_frame,
+)
+from .chatbox_recorder import TrafficRecorder
+from .chatbox_scheduler import EventScheduler, Lane
+from .chatbox_storage import ImageLifecycleManager
 
 DEFAULT_CONFIG = {
     "api_key": "your_secret_key",
     "port": 8080,
     "host": "127.0.0.1",
+    # 额外的监听地址，与主监听地址共享同一份请求表和存储后端。每项形如:
+    #   {"host": "0.0.0.0", "port": 8443, "api_keys": ["key_for_external"]}
+    #   {"unix_path": "/run/astrbot/chatbox.sock", "api_keys": []}
+    # api_keys 为空时沿用上面的 api_key
+    "extra_listeners": [],
+    # 多进程前端：> 0 时由 N 个 worker 进程在 host:port 上处理 HTTP/鉴权/JSON/SSE，
+    # 只把精简后的请求通过 Unix socket 转发给 AstrBot 主进程 (仅支持 Linux/macOS)
+    "frontend_workers": 0,
+    "frontend_ipc_path": "",   # 主进程与 worker 之间的 Unix socket 路径，留空则使用临时目录
     "timeout": 300, # 这是“LLM总超时”，应该设置得较长
     "aggregation_timeout_seconds": 2, # 这是“消息聚合超时”，应该设置得较短
     "default_user_id": "chatbox_api_user",
@@ -58,8 +90,48 @@ DEFAULT_CONFIG = {
                                     # False: 使用公开 URL (http://endpoint/bucket/object)
                                     # True: 使用预签名 URL (http://endpoint/bucket/object?...)
     "minio_expires_duration_hours": 24, # 预签名 URL 有效期 (小时)
+    "minio_retention_days": 0,        # 上传图片的保留天数，0 表示永久保留
+    "minio_lifecycle_mode": "sweeper",  # "sweeper": 后台定期批量删除; "rule": 在存储桶上安装过期规则
+    "minio_sweep_interval_hours": 6,  # 后台扫描 (删除 + 统计) 的间隔 (小时)
+
+    # --- 流量录制 (可选，用于离线回放调优) ---
+    "record_enable": False,                   # 设为 True 以录制每个请求的输入和 send 输出
+    "record_path": "chatbox_traffic.jsonl",   # 录制文件路径 (JSONL)
+    "record_max_bytes": 10 * 1024 * 1024,     # 单个文件最大字节数，超过后滚动
+    "record_backup_count": 5,                 # 保留的历史文件个数
+
+    # --- 批量接口 /v1/batch/chat/completions ---
+    "batch_concurrency": 4,              # 单个批量请求内同时提交给 AstrBot 的请求数
+    "batch_result_cache_size": 10000,    # 缓存的已完成结果条数 (按 API Key + custom_id)，用于断点续跑
+    "batch_max_upload_mb": 64,           # 单次上传的最大大小 (MB)
+    "batch_max_line_kb": 4096,           # 单行的最大大小 (KB)，含 base64 图片时需要适当调大
+
+    # --- 对话指纹 (重新生成 / 编辑时回滚 AstrBot 历史) ---
+    "fingerprint_enable": False,         # 设为 True 以在客户端重新生成或编辑历史消息时回滚 AstrBot 对话历史
+    "fingerprint_max_sessions": 1000,    # 最多跟踪的会话数 (LRU)
+
+    # --- 优先级通道 (在 commit_event 之前调度) ---
+    # 每项形如 {"name": "interactive", "weight": 4, "max_concurrency": 0,
+    #           "command_prefixes": ["/"], "api_keys": [], "user_ids": []}
+    # 按顺序匹配第一条通道，都不匹配的请求进入默认通道。max_concurrency 为 0 表示不限制
+    "priority_lanes": [],
+    "default_lane_weight": 1,
+    "default_lane_max_concurrency": 0,
+    "scheduler_max_inflight": 0,         # 所有通道合计的并发上限，0 表示不限制
 }
 
+class _WorkerResponseQueue:
+    """ 前端 worker 模式下代替 asyncio.Queue：put() 直接把回复块通过 IPC 发给持有该请求的 worker """
+
+    def __init__(self, writer: asyncio.StreamWriter, message_id: str):
+        self.writer = writer
+        self.message_id = message_id
+
+    async def put(self, item):
+        self.writer.write(encode_frame({"op": "item", "message_id": self.message_id, "item": compact_item(item)}))
+        await self.writer.drain()
+
+
 @register_platform_adapter("chatbox", "Chatbox (OpenAI API) 适配器", default_config_tmpl=DEFAULT_CONFIG)
 class ChatboxAdapter(Platform):
 
@@ -95,8 +167,79 @@ class ChatboxAdapter(Platform):
         self.instance_id = self.settings.get("id") or "chatbox"
 
         self.pending_requests = {}
+
+        try:
+            self.batch_concurrency = max(1, int(self.config.get("batch_concurrency", 4)))
+            self.batch_result_cache_size = max(0, int(self.config.get("batch_result_cache_size", 10000)))
+            self.batch_max_upload_bytes = int(float(self.config.get("batch_max_upload_mb", 64)) * 1024 * 1024)
+            self.batch_max_line_bytes = int(float(self.config.get("batch_max_line_kb", 4096)) * 1024)
+        except (ValueError, TypeError):
+            logger.error("【Chatbox 适配器】: 批量接口配置值无效 ('batch_concurrency' 等必须是数字)。")
+            self.batch_concurrency = 4
+            self.batch_result_cache_size = 10000
+            self.batch_max_upload_bytes = 64 * 1024 * 1024
+            self.batch_max_line_bytes = 4096 * 1024
+        # (API Key, custom_id) -> 已成功完成的批量结果，重新上传同一批次时直接返回，不再提交给 AstrBot
+        self.batch_results: OrderedDict[tuple[str, str], dict] = OrderedDict()
+        # 客户端断开后仍在运行的批量 worker，保留引用以免被回收
+        self._batch_tasks: set[asyncio.Task] = set()
+
+        # --- 对话指纹 ---
+        self.fingerprint_index: ConversationFingerprintIndex | None = None
+        if self.config.get("fingerprint_enable", False):
+            try:
+                max_sessions = max(1, int(self.config.get("fingerprint_max_sessions", 1000)))
+            except (ValueError, TypeError):
+                logger.error("【Chatbox 适配器】: 'fingerprint_max_sessions' 配置值无效，必须是整数。")
+                max_sessions = 1000
+            self.fingerprint_index = ConversationFingerprintIndex(max_sessions)
+
+        # --- 优先级通道 ---
+        self.scheduler: EventScheduler | None = None
+        lane_configs = [item for item in (self.config.get("priority_lanes") or []) if isinstance(item, dict)]
+        try:
+            default_lane = Lane(
+                "default",
+                float(self.config.get("default_lane_weight", 1)),
+                int(self.config.get("default_lane_max_concurrency", 0)),
+            )
+            max_inflight = int(self.config.get("scheduler_max_inflight", 0))
+            if lane_configs or default_lane.max_concurrency or max_inflight:
+                self.scheduler = EventScheduler(
+                    [Lane.from_config(conf) for conf in lane_configs],
+                    default_lane,
+                    max_inflight,
+                    self.commit_event,
+                )
+                logger.info(f"【Chatbox 适配器】: 优先级调度已启用，通道: {[lane.name for lane in self.scheduler.all_lanes]}")
+        except (ValueError, TypeError) as e:
+            logger.error(f"【Chatbox 适配器】: 优先级通道配置无效，已禁用调度: {e}")
+            self.scheduler = None
+
         self.runner: web.AppRunner | None = None
         self.site: web.TCPSite | None = None
+        self.sites: list[web.BaseSite] = []
+
+        # --- 多进程前端 ---
+        try:
+            self.frontend_workers = max(0, int(self.config.get("frontend_workers", 0)))
+        except (ValueError, TypeError):
+            logger.error("【Chatbox 适配器】: 'frontend_workers' 配置值无效，必须是整数。")
+            self.frontend_workers = 0
+        if self.frontend_workers and not hasattr(socket, "AF_UNIX"):
+            logger.error("【Chatbox 适配器】: 当前系统不支持 Unix socket，多进程前端已禁用。")
+            self.frontend_workers = 0
+        self.frontend_ipc_path = self.config.get("frontend_ipc_path") or os.path.join(
+            tempfile.gettempdir(), f"chatbox_{self.instance_id}.sock"
+        )
+        self.frontend_proxy_path = f"{self.frontend_ipc_path}.http"
+        self.ipc_server: asyncio.AbstractServer | None = None
+        self.worker_tasks: list[asyncio.Task] = []
+
+        # 额外监听地址。每个监听器使用独立的 AppRunner，API Key 白名单跟随监听器本身，
+        # 不依赖端口号区分 (同一端口、不同 host 的监听器互不影响)
+        self.extra_listeners = [item for item in (self.config.get("extra_listeners") or []) if isinstance(item, dict)]
+        self.extra_runners: list[web.AppRunner] = []
 
         # --- MinIO Client ---
         self.minio_client: Minio | None = None
@@ -140,6 +283,48 @@ class ChatboxAdapter(Platform):
                 except Exception as e:
                     logger.error(f"【Chatbox 适配器】: 初始化 MinIO 客户端时发生未知错误: {e}")
                     self.minio_client = None
+
+        # --- 图片对象生命周期 ---
+        self.image_lifecycle: ImageLifecycleManager | None = None
+        if self.minio_client:
+            try:
+                retention_days = max(0, int(self.config.get("minio_retention_days", 0)))
+                interval_hours = float(self.config.get("minio_sweep_interval_hours", 6))
+            except (ValueError, TypeError):
+                logger.error("【Chatbox 适配器】: 'minio_retention_days' 或 'minio_sweep_interval_hours' 配置值无效，必须是数字。")
+                retention_days, interval_hours = 0, 6.0
+            lifecycle_mode = self.config.get("minio_lifecycle_mode", "sweeper")
+            if lifecycle_mode not in ("sweeper", "rule"):
+                logger.error(f"【Chatbox 适配器】: 未知的 'minio_lifecycle_mode': {lifecycle_mode}，使用 'sweeper'。")
+                lifecycle_mode = "sweeper"
+
+            self.image_lifecycle = ImageLifecycleManager(
+                self.minio_client, self.minio_bucket, retention_days, lifecycle_mode, interval_hours
+            )
+            try:
+                if retention_days and lifecycle_mode == "rule":
+                    self.image_lifecycle.install_lifecycle_rule()
+                else:
+                    # 之前以 rule 模式运行时安装的规则必须移除，否则 MinIO 会继续按旧的保留天数删除对象
+                    self.image_lifecycle.remove_lifecycle_rule()
+            except S3Error as e:
+                logger.error(f"【Chatbox 适配器】: 更新 MinIO 生命周期规则失败: {e}")
+
+        # --- 流量录制 ---
+        self.recorder: TrafficRecorder | None = None
+        if self.config.get("record_enable", False):
+            record_path = self.config.get("record_path", "chatbox_traffic.jsonl")
+            try:
+                self.recorder = TrafficRecorder(
+                    record_path,
+                    int(self.config.get("record_max_bytes", 10 * 1024 * 1024)),
+                    int(self.config.get("record_backup_count", 5)),
+                )
+                logger.info(f"【Chatbox 适配器】: 流量录制已启用，写入 {record_path}")
+            except (ValueError, TypeError, OSError) as e:
+                logger.error(f"【Chatbox 适配器】: 初始化流量录制失败: {e}")
+                self.recorder = None
+
     def meta(self) -> PlatformMetadata:
         return PlatformMetadata(
             "chatbox",
@@ -150,10 +335,23 @@ class ChatboxAdapter(Platform):
         logger.warning("ChatboxAdapter 不支持主动消息 (send_by_session)")
         pass
 
-    async def run(self):
-        app = web.Application()
+    def build_app(self, api_keys: set[str] | None = None) -> web.Application:
+        """ 创建一个监听器使用的 aiohttp 应用；api_keys 非空时该监听器只接受这些 Key """
+
+        @web.middleware
+        async def listener_auth(request: web.Request, handler):
+            request["chatbox_api_keys"] = api_keys
+            return await handler(request)
+
+        app = web.Application(middlewares=[listener_auth])
         app.router.add_get("/v1/models", self.handle_list_models)
         app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        app.router.add_post("/v1/batch/chat/completions", self.handle_batch_completions)
+        app.router.add_get("/v1/chatbox/storage", self.handle_storage_stats)
+        return app
+
+    async def run(self):
+        app = self.build_app()
 
         self.runner = web.AppRunner(app)
         await self.runner.setup()
@@ -173,8 +371,19 @@ class ChatboxAdapter(Platform):
             return
 
         try:
-            await self.site.start()
-            logger.info(f"Chatbox (OpenAI API) 适配器成功在 http://{self.host}:{self.port} 上监听。")
+            if self.frontend_workers:
+                # 主端口交给 worker 进程，主进程只处理 IPC 和额外监听地址
+                await self.start_frontend_workers()
+            else:
+                await self.site.start()
+                self.sites.append(self.site)
+                logger.info(f"Chatbox (OpenAI API) 适配器成功在 http://{self.host}:{self.port} 上监听。")
+
+            await self.start_extra_listeners()
+
+            if self.image_lifecycle:
+                # 即使不删除 (retention_days 为 0)，也需要定期扫描以保持存储统计准确
+                self.image_lifecycle.start()
 
             while True:
                 await asyncio.sleep(3600)
@@ -192,6 +401,15 @@ class ChatboxAdapter(Platform):
             logger.error(f"Chatbox 适配器 run 循环中发生未知错误: {e}")
         finally:
             logger.info(f"正在终止 Chatbox (OpenAI API) 适配器 http://{self.host}:{self.port} ...")
+            await self.stop_frontend_workers()
+            for runner in self.extra_runners:
+                try:
+                    await asyncio.wait_for(runner.cleanup(), timeout=3.0)
+                except Exception as e:
+                    logger.error(f"【Chatbox 适配器】: 停止额外监听器失败: {e}")
+            self.extra_runners.clear()
+            if self.image_lifecycle:
+                await self.image_lifecycle.stop()
             if self.runner:
                 try:
                     await asyncio.wait_for(self.runner.cleanup(), timeout=3.0)
@@ -203,15 +421,190 @@ class ChatboxAdapter(Platform):
 
             self.runner = None
             self.site = None
+            self.sites.clear()
+
+            if self.recorder:
+                self.recorder.close()
+
+    async def start_frontend_workers(self):
+        """ 启动 IPC 服务和 N 个前端 worker 进程 """
+        path = self.frontend_ipc_path
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        self.ipc_server = await asyncio.start_unix_server(self.handle_worker_connection, path)
+        # worker 已完成鉴权，主进程信任 IPC 上的请求，因此只允许当前用户连接
+        os.chmod(path, 0o600)
+
+        # worker 未实现的接口 (批量、存储统计等) 由 worker 转发到主进程的这个内部 HTTP 监听，仍由主进程鉴权
+        proxy_path = self.frontend_proxy_path
+        if os.path.exists(proxy_path) and stat.S_ISSOCK(os.stat(proxy_path).st_mode):
+            os.unlink(proxy_path)
+        site = web.UnixSite(self.runner, proxy_path)
+        await site.start()
+        os.chmod(proxy_path, 0o600)
+        self.sites.append(site)
+
+        worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chatbox_worker.py")
+        for worker_id in range(self.frontend_workers):
+            self.worker_tasks.append(asyncio.create_task(self._supervise_worker(worker_id, worker_script)))
+        logger.info(f"Chatbox (OpenAI API) 适配器已启动 {self.frontend_workers} 个前端 worker，监听 http://{self.host}:{self.port}，IPC: {path}")
+
+    async def _supervise_worker(self, worker_id: int, worker_script: str):
+        """ 运行并守护一个 worker 进程，异常退出后自动重启 """
+        while True:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    sys.executable, worker_script,
+                    "--host", str(self.host),
+                    "--port", str(self.port),
+                    "--ipc-path", self.frontend_ipc_path,
+                    "--worker-id", str(worker_id),
+                )
+            except OSError as e:
+                logger.error(f"【Chatbox 适配器】: 启动前端 worker {worker_id} 失败: {e}")
+                return
+            try:
+                returncode = await proc.wait()
+            except asyncio.CancelledError:
+                if proc.returncode is None:
+                    proc.terminate()
+                    try:
+                        await asyncio.wait_for(proc.wait(), timeout=3.0)
+                    except asyncio.TimeoutError:
+                        proc.kill()
+                raise
+            logger.warning(f"【Chatbox 适配器】: 前端 worker {worker_id} 退出 (code={returncode})，5 秒后重启。")
+            await asyncio.sleep(5)
+
+    async def stop_frontend_workers(self):
+        for task in self.worker_tasks:
+            task.cancel()
+        if self.worker_tasks:
+            await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks.clear()
+
+        if self.ipc_server:
+            self.ipc_server.close()
+            self.ipc_server = None
+            for path in (self.frontend_ipc_path, self.frontend_proxy_path):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
 
-    async def handle_list_models(self, request: web.Request):
+    async def handle_worker_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ 处理一个 worker 的 IPC 连接：接收精简请求并提交事件，回复块经 _WorkerResponseQueue 发回 """
+        owned: set[str] = set()
+        try:
+            writer.write(encode_frame({
+                "op": "config",
+                "api_key": self.api_key,
+                "timeout": self.timeout,
+                "aggregation_timeout": self.aggregation_timeout,
+                "fingerprint": self.fingerprint_index is not None,
+                "proxy_path": self.frontend_proxy_path,
+            }))
+            await writer.drain()
+
+            while True:
+                frame = await read_frame(reader)
+                op = frame.get("op")
+                if op == "req":
+                    request = frame.get("request") or {}
+                    try:
+                        abm, model_name, _ = await self.dispatch_request(
+                            request,
+                            bool(request.get("stream", False)),
+                            queue_factory=lambda message_id: _WorkerResponseQueue(writer, message_id),
+                            api_key=frame.get("api_key"),
+                            compact=True,
+                        )
+                    except ValueError as e:
+                        reply = {"op": "error", "rid": frame["rid"], "status": 400, "error": str(e)}
+                    except Exception as e:
+                        logger.error(f"【Chatbox 适配器】: 处理 worker 转发的请求时出错: {e}")
+                        reply = {"op": "error", "rid": frame["rid"], "status": 500, "error": "Internal server error"}
+                    else:
+                        # 与 dispatch_request 之间没有 await，accepted 帧一定先于任何 item 帧写出
+                        owned.add(abm.message_id)
+                        reply = {"op": "accepted", "rid": frame["rid"], "message_id": abm.message_id, "model": model_name}
+                    writer.write(encode_frame(reply))
+                    await writer.drain()
+                elif op == "done":
+                    owned.discard(frame["message_id"])
+                    self._finish_request(frame["message_id"])
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.debug("【Chatbox 适配器】: 前端 worker 断开了 IPC 连接。")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"【Chatbox 适配器】: IPC 连接发生未知错误: {e}")
+        finally:
+            for message_id in owned:
+                self._finish_request(message_id)
+            writer.close()
+
+    async def start_extra_listeners(self):
+        """ 启动 extra_listeners 中配置的 TCP / Unix socket 监听器，单个失败不影响其它监听器 """
+        for listener in self.extra_listeners:
+            unix_path = listener.get("unix_path")
+            runner = None
+            try:
+                if unix_path:
+                    if not hasattr(socket, "AF_UNIX"):
+                        logger.error(f"【Chatbox 适配器】: 当前系统不支持 Unix socket，跳过监听器 {unix_path}")
+                        continue
+                    address = f"unix:{unix_path}"
+                else:
+                    host = listener.get("host", self.host)
+                    port = int(listener["port"])
+                    address = f"http://{host}:{port}"
+
+                api_keys = {k for k in (listener.get("api_keys") or []) if k}
+                runner = web.AppRunner(self.build_app(api_keys or None))
+                await runner.setup()
+                if unix_path:
+                    # 清理上次异常退出遗留的 socket 文件
+                    if os.path.exists(unix_path) and stat.S_ISSOCK(os.stat(unix_path).st_mode):
+                        os.unlink(unix_path)
+                    site = web.UnixSite(runner, unix_path)
+                else:
+                    site = web.TCPSite(runner, host, port, reuse_address=True, reuse_port=True)
+
+                await site.start()
+                self.extra_runners.append(runner)
+                self.sites.append(site)
+                logger.info(f"Chatbox (OpenAI API) 适配器成功在 {address} 上监听。")
+            except (KeyError, ValueError, TypeError) as e:
+                logger.error(f"【Chatbox 适配器】: 监听器配置无效 {listener}: {e}")
+            except OSError as e:
+                logger.error(f"【Chatbox 适配器】: 启动监听器 {listener} 失败: {e}")
+                if runner:
+                    await runner.cleanup()
+
+    @staticmethod
+    def bearer_token(request: web.Request) -> str | None:
         auth_header = request.headers.get("Authorization")
         if not auth_header or not auth_header.startswith("Bearer "):
+            return None
+        return auth_header.split(" ")[1]
+
+    def check_auth(self, request: web.Request) -> web.Response | None:
+        """ 校验 Bearer Token，通过时返回 None，否则返回 401 响应 """
+        token = self.bearer_token(request)
+        if token is None:
             return web.json_response({"error": "Missing Authorization header"}, status=401)
 
-        token = auth_header.split(" ")[1]
-        if self.api_key and token != self.api_key:
+        allowed = request.get("chatbox_api_keys") or ({self.api_key} if self.api_key else None)
+        if allowed and token not in allowed:
             return web.json_response({"error": "Invalid API key"}, status=401)
+        return None
+
+    async def handle_list_models(self, request: web.Request):
+        auth_error = self.check_auth(request)
+        if auth_error:
+            return auth_error
 
         model_data = {
             "object": "list",
@@ -226,14 +619,19 @@ class ChatboxAdapter(Platform):
         }
         return web.json_response(model_data)
 
-    async def handle_chat_completions(self, request: web.Request):
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or not auth_header.startswith("Bearer "):
-            return web.json_response({"error": "Missing Authorization header"}, status=401)
+    async def handle_storage_stats(self, request: web.Request):
+        auth_error = self.check_auth(request)
+        if auth_error:
+            return auth_error
 
-        token = auth_header.split(" ")[1]
-        if self.api_key and token != self.api_key:
-            return web.json_response({"error": "Invalid API key"}, status=401)
+        if not self.image_lifecycle:
+            return web.json_response({"error": "MinIO is not enabled"}, status=404)
+        return web.json_response(self.image_lifecycle.stats())
+
+    async def handle_chat_completions(self, request: web.Request):
+        auth_error = self.check_auth(request)
+        if auth_error:
+            return auth_error
 
         try:
             body = await request.json()
@@ -243,12 +641,189 @@ class ChatboxAdapter(Platform):
         is_stream = body.get("stream", False)
 
         try:
-            abm, model_name = await self.convert_openai_to_abm(body)
+            abm, model_name, response_queue = await self.dispatch_request(body, is_stream, api_key=self.bearer_token(request))
         except ValueError as e:
             return web.json_response({"error": str(e)}, status=400)
 
-        response_queue = asyncio.Queue()
+        if is_stream:
+            try:
+                # 发送一个初始空块，让客户端知道连接已建立
+                empty_chunk = self.format_as_openai_chunk({}, abm.message_id, model_name)
+                asyncio.create_task(self.safe_queue_put(response_queue, empty_chunk))
+            except Exception:
+                pass # 忽略心跳发送失败
+            return await self.handle_stream_response(request, abm.message_id, response_queue)
+        else:
+            return await self.handle_non_stream_response(abm.message_id, response_queue)
+
+    async def handle_batch_completions(self, request: web.Request):
+        """
+        批量接口：请求体为 JSONL，每行一个对话请求，可以是 OpenAI Batch 格式
+        {"custom_id": ..., "body": {...}}，也可以直接是对话请求体 (可带 "custom_id")。
+        边读取上传边提交，以 JSONL 流式返回结果，每完成一条写一行 (顺序为完成顺序，而非上传顺序)。
+        """
+        auth_error = self.check_auth(request)
+        if auth_error:
+            return auth_error
+
+        if request.content_length and request.content_length > self.batch_max_upload_bytes:
+            return web.json_response({"error": f"Upload exceeds {self.batch_max_upload_bytes} bytes"}, status=413)
+
+        token = self.bearer_token(request) or ""
+
+        response = web.StreamResponse(
+            status=200,
+            reason="OK",
+            headers={"Content-Type": "application/x-ndjson", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+
+        # 有界的工作队列 + 固定数量的 worker：上传再大，同时存在的待处理行也不超过 2 * batch_concurrency
+        work: asyncio.Queue = asyncio.Queue(maxsize=self.batch_concurrency)
+        results: asyncio.Queue = asyncio.Queue()
+        stopping = asyncio.Event()
+
+        async def _worker():
+            while True:
+                item = await work.get()
+                if item is None:
+                    return
+                if stopping.is_set():
+                    continue  # 客户端已断开：尚未开始的行不再提交
+                await results.put(await self._run_batch_line(token, *item))
+
+        async def _producer():
+            try:
+                async for kind, value in self._iter_batch_lines(request):
+                    if stopping.is_set():
+                        break
+                    if kind == "row":
+                        await results.put(value)
+                    else:
+                        await work.put(value)
+            except Exception as e:
+                if not stopping.is_set():
+                    logger.warning(f"【Chatbox 适配器】: (Batch) 读取上传内容失败: {e}")
+                    await results.put({"custom_id": None, "response": None, "error": {"message": f"Failed to read upload: {e}"}})
+            finally:
+                for _ in workers:
+                    await work.put(None)
+
+        async def _run_all():
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+            await results.put(None)
+
+        workers = [asyncio.create_task(_worker()) for _ in range(self.batch_concurrency)]
+        producer = asyncio.create_task(_producer())
+        for task in (*workers, producer, asyncio.create_task(_run_all())):
+            # 客户端断开时不取消这些任务：已提交给 AstrBot 的行继续完成并写入缓存，续跑时无需重跑
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+        completed = 0
+        try:
+            while (row := await results.get()) is not None:
+                await response.write((json.dumps(row, ensure_ascii=False) + "\n").encode())
+                completed += 1
+        except (ConnectionError, asyncio.CancelledError) as e:
+            logger.warning(f"【Chatbox 适配器】: (Batch) 客户端提前断开，已返回 {completed} 条，进行中的请求将完成并写入缓存。")
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return response
+        finally:
+            stopping.set()
+
+        logger.info(f"【Chatbox 适配器】: (Batch) 批量请求完成，共返回 {completed} 条。")
+        await response.write_eof()
+        return response
+
+    async def _iter_batch_lines(self, request: web.Request):
+        """
+        逐块读取上传内容并按行解析，产出 ("row", 结果行) 或 ("work", (custom_id, body, 可缓存))。
+        超过 batch_max_line_bytes 的行直接返回错误行并跳过；累计超过 batch_max_upload_bytes 时停止读取。
+        """
+        seen: set[str] = set()
+
+        def _parse(line_no: int, line: bytes):
+            if not line.strip():
+                return None
+            try:
+                item = json.loads(line)
+                if not isinstance(item, dict):
+                    raise ValueError("line is not a JSON object")
+            except ValueError as e:
+                return "row", {"custom_id": f"line-{line_no}", "response": None, "error": {"message": f"Invalid JSON on line {line_no}: {e}"}}
+
+            custom_id = item.get("custom_id")
+            body = item.get("body") if isinstance(item.get("body"), dict) else item
+            if not custom_id:
+                # 没有 custom_id 的行无法在续跑时识别，只执行不缓存
+                return "work", (f"line-{line_no}", body, False)
+            custom_id = str(custom_id)
+            if custom_id in seen:
+                return "row", {"custom_id": custom_id, "response": None, "error": {"message": f"Duplicate custom_id on line {line_no}"}}
+            seen.add(custom_id)
+            return "work", (custom_id, body, True)
+
+        try:
+            async for line_no, line in iter_jsonl_lines(request.content.iter_any(), self.batch_max_line_bytes, self.batch_max_upload_bytes):
+                if line is None:
+                    yield "row", {"custom_id": f"line-{line_no}", "response": None, "error": {"message": f"Line {line_no} exceeds {self.batch_max_line_bytes} bytes"}}
+                    continue
+                parsed = _parse(line_no, line)
+                if parsed:
+                    yield parsed
+        except UploadTooLarge as e:
+            yield "row", {"custom_id": None, "response": None, "error": {"message": f"{e}, remaining lines ignored"}}
+
+    async def _run_batch_line(self, token: str, custom_id: str, body: dict, cacheable: bool) -> dict:
+        """ 执行批量中的一行，任何异常都转换为错误行，不影响其它行 """
+        cache_key = (token, custom_id) if cacheable else None
+        if cache_key:
+            cached = self.batch_results.get(cache_key)
+            if cached is not None:
+                self.batch_results.move_to_end(cache_key)
+                return {**cached, "cached": True}
+
+        try:
+            abm, _, queue = await self.dispatch_request({**body, "stream": False}, False, api_key=token or None)
+        except ValueError as e:
+            return {"custom_id": custom_id, "response": {"status_code": 400, "body": {"error": str(e)}}, "error": None}
+        except Exception as e:
+            logger.error(f"【Chatbox 适配器】: (Batch) 提交 {custom_id} 时出错: {e}")
+            return {"custom_id": custom_id, "response": None, "error": {"message": f"Invalid request: {e}"}}
+
+        try:
+            payload, status = await self.collect_non_stream_response(abm.message_id, queue)
+        except Exception as e:
+            logger.error(f"【Chatbox 适配器】: (Batch) 等待 {custom_id} 的回复时出错: {e}")
+            return {"id": abm.message_id, "custom_id": custom_id, "response": None, "error": {"message": "Internal server error"}}
+
+        result = {"id": abm.message_id, "custom_id": custom_id, "response": {"status_code": status, "body": payload}, "error": None}
+        if cache_key and status == 200 and self.batch_result_cache_size:
+            self.batch_results[cache_key] = result
+            while len(self.batch_results) > self.batch_result_cache_size:
+                self.batch_results.popitem(last=False)
+        return result
+
+    async def dispatch_request(self, body: dict, is_stream: bool, queue_factory=None, api_key: str | None = None,
+                               compact: bool = False) -> tuple[AstrBotMessage, str, asyncio.Queue]:
+        """
+        转换请求体、注册响应队列并提交事件。请求体无效时抛出 ValueError。
+        queue_factory(message_id) 可替换默认的 asyncio.Queue (前端 worker 模式下直接转发给 worker)。
+        api_key 为客户端使用的 Token，用于匹配优先级通道。
+        compact 为 True 时 body 已经是 compact_request 的结果 (由前端 worker 完成精简)。
+        """
+        if compact:
+            request, raw_body = body, expand_request(body)
+        else:
+            request, raw_body = compact_request(body, message_digests if self.fingerprint_index else None), body
+        abm, model_name = self.build_abm(request, raw_body)
+
+        response_queue = queue_factory(abm.message_id) if queue_factory else asyncio.Queue()
         self.pending_requests[abm.message_id] = response_queue
+        if self.recorder:
+            self.recorder.record_request(abm, model_name, is_stream)
 
         if self.spoof_platform:
             platform_meta = PlatformMetadata(self.spoof_platform, f"Spoofed {self.spoof_platform}")
@@ -265,18 +840,27 @@ class ChatboxAdapter(Platform):
             model_name=model_name
         )
 
-        self.commit_event(message_event)
+        if self.fingerprint_index and "digests" in request:
+            message_event.fingerprint_turn, message_event.history_rollback = self.fingerprint_index.observe(
+                abm.session_id, request["digests"], request["turn"]
+            )
+            if message_event.history_rollback:
+                logger.info(f"【Chatbox 适配器】: 会话 {abm.session_id} 检测到重新生成/编辑，将回滚 {len(message_event.history_rollback)} 轮历史。")
 
-        if is_stream:
-            try:
-                # 发送一个初始空块，让客户端知道连接已建立
-                empty_chunk = self.format_as_openai_chunk({}, abm.message_id, model_name)
-                asyncio.create_task(self.safe_queue_put(response_queue, empty_chunk))
-            except Exception:
-                pass # 忽略心跳发送失败
-            return await self.handle_stream_response(request, abm.message_id, response_queue)
+        if self.scheduler:
+            lane = self.scheduler.classify(abm.message_str, api_key, str(abm.sender.user_id))
+            self.scheduler.submit(abm.message_id, message_event, lane)
         else:
-            return await self.handle_non_stream_response(abm.message_id, response_queue)
+            self.commit_event(message_event)
+        return abm, model_name, response_queue
+
+    def _finish_request(self, message_id: str):
+        """ 请求结束 (正常、超时或出错) 时统一清理 """
+        self.pending_requests.pop(message_id, None)
+        if self.scheduler:
+            self.scheduler.release(message_id)
+        if self.recorder:
+            self.recorder.record_end(message_id)
 
     async def safe_queue_put(self, queue: asyncio.Queue, item: any):
         """ 异步安全地向队列放入元素，忽略可能的队列关闭错误 """
@@ -287,69 +871,15 @@ class ChatboxAdapter(Platform):
 
 
     async def handle_non_stream_response(self, message_id: str, queue: asyncio.Queue):
-        final_response = None
-
-        # 嵌套函数，用于被 wait_for 包裹
-        async def _responder():
-            nonlocal final_response
-            # --- 1. 等待第一条消息 ---
-            # 这里的 queue.get() 受外层的 self.timeout 限制
-            try:
-                item = await queue.get()
-                if isinstance(item, dict):
-                    final_response = item # 存储第一条消息
-            except asyncio.CancelledError:
-                raise
-            except Exception as e:
-                logger.error(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 等待第一条消息时出错: {e}")
-                raise
-
-            # --- 2. 循环等待后续消息 (聚合) ---
-            try:
-                while True:
-                    # 内层: 聚合超时 (例如 2s)
-                    item = await asyncio.wait_for(queue.get(), timeout=self.aggregation_timeout)
-                    if isinstance(item, dict):
-                        final_response = item # 持续覆盖，只保留最后一个聚合响应
-
-            except asyncio.TimeoutError:
-                # --- 正常退出 (聚合超时) ---
-                # 内层的 aggregation_timeout 触发，意味着Bot停止发送消息。
-                logger.debug(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 聚合超时，准备发送回复。")
-                pass # 正常退出
-
-            except asyncio.CancelledError:
-                logger.debug(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 内部循环被取消。")
-                raise
+        payload, status = await self.collect_non_stream_response(message_id, queue)
+        return web.json_response(payload, status=status)
 
+    async def collect_non_stream_response(self, message_id: str, queue: asyncio.Queue) -> tuple[dict, int]:
+        """ 等待并聚合非流式回复，返回 (响应体, HTTP 状态码) """
         try:
-            # --- 外层: LLM总超时 ---
-            # 使用兼容的 asyncio.wait_for 替代 asyncio.timeout
-            await asyncio.wait_for(_responder(), timeout=self.timeout)
-
-        except asyncio.TimeoutError:
-            # --- 异常退出 (LLM总超时) ---
-            logger.warning(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} *总超时* (LLM超时)。")
-            if not final_response:
-                self.pending_requests.pop(message_id, None)
-                return web.json_response({"error": f"Request timed out after {self.timeout}s (no first reply)"}, status=504)
-            logger.warning(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 返回*部分*聚合回复。")
-
-        except Exception as e:
-            logger.error(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 发生未知错误: {e}")
-            if not final_response:
-                self.pending_requests.pop(message_id, None)
-                return web.json_response({"error": "Internal server error"}, status=500)
-
+            return await collect_non_stream(queue, message_id, self.timeout, self.aggregation_timeout, logger)
         finally:
-            self.pending_requests.pop(message_id, None)
-
-        # --- 统一出口 ---
-        if final_response:
-            return web.json_response(final_response)
-        else:
-            logger.warning(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 未收到任何有效回复。")
-            return web.json_response({"error": "No response from bot"}, status=500)
+            self._finish_request(message_id)
 
     async def handle_stream_response(self, request: web.Request, message_id: str, queue: asyncio.Queue):
         response = web.StreamResponse(
@@ -359,132 +889,28 @@ class ChatboxAdapter(Platform):
         )
         await response.prepare(request)
 
-        model_name = "astrbot-stream" # 默认模型名
-
-        # 嵌套函数，用于被 wait_for 包裹
-        async def _responder():
-            nonlocal model_name
-            # --- 1. 等待第一条 *有效* 消息 ---
-            try:
-                while True:
-                    # 这里的 queue.get() 受外层的 self.timeout 限制
-                    chunk = await queue.get()
-                    if chunk.get("model"):
-                        model_name = chunk.get("model")
-
-                    # [修复] 只有在收到 *非空* 块时才算 "第一条消息"
-                    # 如果是空的心跳块, (delta == {})，则继续循环
-                    if not (chunk.get("choices") and chunk["choices"][0].get("delta") == {}):
-                        # 这是一个有效块 (文本, tool_call, 或 stop)
-                        chunk_json = json.dumps(chunk)
-                        await response.write(f"data: {chunk_json}\n\n".encode())
-                        # 收到有效块，跳出Step 1的循环, 进入Step 2
-                        break
-                    else:
-                        # 是空块 (delta == {})，忽略并继续等待第一条 *有效* 消息
-                        logger.debug("【Chatbox 适配器】: (Stream) 收到并忽略了心跳空块")
-
-            except asyncio.CancelledError:
-                raise # 如果被取消，直接抛出
-            except Exception as e:
-                logger.error(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 等待第一条消息时出错: {e}")
-                raise # 抛出错误到外层 catch
-
-            # --- 2. 循环等待后续消息 (聚合) ---
-            try:
-                while True:
-                    # 内层: 聚合超时 (例如 3s)
-                    chunk = await asyncio.wait_for(queue.get(), timeout=self.aggregation_timeout)
-
-                    # (K线图的第二条消息会在这里被捕获)
-                    if chunk.get("choices") and chunk["choices"][0].get("delta") == {}:
-                        continue # 跳过后续可能的心跳块
-
-                    chunk_json = json.dumps(chunk)
-                    await response.write(f"data: {chunk_json}\n\n".encode())
-
-            except asyncio.TimeoutError:
-                # --- 正常退出 (聚合超时) ---
-                logger.debug(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 聚合超时，正常关闭流。")
-                pass # 正常退出
-
-            except asyncio.CancelledError:
-                logger.debug(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 内部循环被取消。")
-                raise
-
         try:
-            # --- 外层: LLM总超时 ---
-            await asyncio.wait_for(_responder(), timeout=self.timeout)
-
-        except asyncio.TimeoutError:
-            # --- 异常退出 (LLM总超时) ---
-            logger.warning(f"【Chatbox 适配器】: (Stream) 队列 {message_id} *总超时* (LLM超时)。")
-            # 同样进入 finally 块发送 [DONE]
-
-        except Exception as e:
-            logger.error(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 发生未知错误: {e} (in _responder: {type(e)})")
-            # 同样进入 finally 块发送 [DONE]
-
+            await pump_stream(queue, response.write, message_id, self.timeout, self.aggregation_timeout, logger)
         finally:
-            # --- 统一出口：必须关闭客户端流 ---
-            try:
-                logger.debug(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 正在发送 'stop' 和 [DONE]...")
-                # 1. 发送 'stop' 信号块
-                stop_chunk = self.format_as_openai_chunk(
-                    {"finish_reason": "stop"},
-                    message_id,
-                    model_name
-                )
-                chunk_json = json.dumps(stop_chunk)
-                await response.write(f"data: {chunk_json}\n\n".encode())
-
-                # 2. 发送 [DONE] 终止信号
-                await response.write(b"data: [DONE]\n\n")
-
-            except Exception as e:
-                logger.warning(f"【Chatbox 适配器】: (Stream) 写入最终 [DONE] 失败 (客户端可能已提前断开): {e}")
-
-            self.pending_requests.pop(message_id, None)
+            self._finish_request(message_id)
             await response.write_eof()
 
         return response
 
-    async def convert_openai_to_abm(self, body: dict) -> tuple[AstrBotMessage, str]:
-        messages = body.get("messages", [])
-        if not messages:
-            raise ValueError("Missing 'messages' field")
-
-        last_user_msg = None
-        for msg in reversed(messages):
-            if msg.get("role") == "user":
-                last_user_msg = msg
-                break
-
-        if not last_user_msg:
-            raise ValueError("No 'user' role message found")
-
-        content = last_user_msg.get("content")
+    def build_abm(self, request: dict, raw_body: dict) -> tuple[AstrBotMessage, str]:
+        """ 由 compact_request 的结果构造 AstrBotMessage，raw_body 作为 raw_message 保存 """
         chain = []
-
-        if isinstance(content, str):
-            chain.append(Plain(text=content))
-        elif isinstance(content, list):
-            for part in content:
-                if part.get("type") == "text":
-                    chain.append(Plain(text=part.get("text", "")))
-                elif part.get("type") == "image_url":
-                    img_url = part.get("image_url", {}).get("url", "")
-                    if img_url:
-                        chain.append(Image(file=img_url))
-
-        if not chain:
-            raise ValueError("User message content is empty or unsupported")
+        for part in request["parts"]:
+            if part["type"] == "text":
+                chain.append(Plain(text=part["text"]))
+            else:
+                chain.append(Image(file=part["image_url"]["url"]))
 
         abm = AstrBotMessage()
 
         abm.type = MessageType.FRIEND_MESSAGE
 
-        user_id = self.spoof_user_id if self.spoof_user_id else body.get("user", self.default_user_id)
+        user_id = self.spoof_user_id if self.spoof_user_id else request.get("user", self.default_user_id)
         nickname = self.spoof_nickname if self.spoof_nickname else self.default_nickname
 
         abm.session_id = user_id
@@ -498,55 +924,14 @@ class ChatboxAdapter(Platform):
         abm.message_id = f"chatcmpl-{uuid.uuid4()}"
         abm.message = chain
         abm.message_str = " ".join([p.text for p in chain if isinstance(p, Plain)])
-        abm.raw_message = body
+        abm.raw_message = raw_body
 
-        model_name = body.get("model", "astrbot-default-model")
+        model_name = request.get("model", "astrbot-default-model")
 
         return abm, model_name
 
     def format_as_openai_response(self, content: str, msg_id: str, model: str, finish_reason: str = "stop", tool_calls: list = None) -> dict:
-        message = {
-            "role": "assistant",
-            "content": content if not tool_calls else None,
-        }
-        if tool_calls:
-            message["tool_calls"] = tool_calls
-
-        return {
-            "id": msg_id,
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [
-                {
-                    "index": 0,
-                    "message": message,
-                    "finish_reason": finish_reason
-                }
-            ],
-            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-        }
+        return format_as_openai_response(content, msg_id, model, finish_reason, tool_calls)
 
     def format_as_openai_chunk(self, delta: dict, msg_id: str, model: str) -> dict:
-        choice_delta = {}
-        if "content" in delta:
-            choice_delta = {"role": "assistant", "content": delta["content"]}
-        elif "tool_calls" in delta:
-            choice_delta = {"role": "assistant", "tool_calls": delta["tool_calls"]}
-
-        finish_reason = delta.get("finish_reason")
-
-        return {
-            "id": msg_id,
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": choice_delta if choice_delta else {},
-                    "logprobs": None,
-                    "finish_reason": finish_reason
-                }
-            ]
-        }
+        return format_as_openai_chunk(delta, msg_id, model)
@@ -2,7 +2,6 @@ import datetime
 import mimetypes
 import os
 import typing
-import uuid
 from urllib.parse import quote
 
 from astrbot.api import logger
@@ -10,6 +9,8 @@ from astrbot.api.event import AstrMessageEvent, MessageChain
 from astrbot.api.message_components import Image, Plain
 from astrbot.api.platform import AstrBotMessage, PlatformMetadata
 
+from .chatbox_storage import build_object_name
+
 if typing.TYPE_CHECKING:
     from .chatbox_adapter import ChatboxAdapter
 
@@ -29,6 +30,9 @@ class ChatboxEvent(AstrMessageEvent):
         self.model_name = model_name
         # aggregated_content 现在用于非流式模式的聚合
         self.aggregated_content = ""
+        # 对话指纹：本轮 user 消息在整个对话中的位置，以及需要回滚的 AstrBot 历史轮次的 user 文本
+        self.fingerprint_turn: int | None = None
+        self.history_rollback: list[str] = []
 
     async def send(self, message: MessageChain):
         req_id = self.message_obj.message_id
@@ -79,6 +83,9 @@ class ChatboxEvent(AstrMessageEvent):
             await super().send(message)
             return # 不发送任何内容到队列
 
+        if self.client.recorder:
+            self.client.recorder.record_send(req_id, reply_content)
+
         if self.is_stream:
             # --- 流式：只发送新内容块 ---
             # **重要：不再发送 [DONE] 或 stop_chunk**
@@ -119,8 +126,8 @@ class ChatboxEvent(AstrMessageEvent):
 
         # 1. 准备对象名称和内容类型
         file_name = os.path.basename(local_path)
-        # 创建一个唯一的对象名称，避免冲突
-        object_name = f"chatbox_adapter/{uuid.uuid4()}/{file_name}"
+        # 创建一个唯一的对象名称，避免冲突 (按日期分区，便于过期清理)
+        object_name = build_object_name(file_name)
 
         content_type, _ = mimetypes.guess_type(local_path)
         if not content_type:
@@ -135,6 +142,8 @@ class ChatboxEvent(AstrMessageEvent):
             local_path,
             content_type=content_type
         )
+        if self.client.image_lifecycle:
+            self.client.image_lifecycle.record_upload(os.path.getsize(local_path))
 
         # 3. 生成 URL
         if self.client.minio_use_presigned_url:
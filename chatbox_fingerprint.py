@@ -0,0 +1,130 @@
+import hashlib
+import json
+from collections import OrderedDict
+
+
+def _message_digest(msg: dict) -> str:
+    canonical = json.dumps(
+        {k: msg.get(k) for k in ("role", "content", "name", "tool_calls", "tool_call_id")},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def message_digests(messages: list) -> list[str]:
+    """ 每条消息各自的摘要 (不做链式)，客户端从前面截断上下文时仍能与上一次请求对齐；十六进制字符串便于经 IPC 传输 """
+    return [_message_digest(msg if isinstance(msg, dict) else {"content": msg}) for msg in messages]
+
+
+def _context_text(msg: dict) -> str:
+    content = msg.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(p.get("text", "") for p in content if isinstance(p, dict) and p.get("type") == "text")
+    return ""
+
+
+def trim_dropped_turns(contexts: list, dropped: list[str]) -> list:
+    """
+    从 AstrBot 对话上下文中删除被客户端丢弃的轮次 (dropped 为这些轮次的 user 文本，按先后顺序)。
+    按内容定位第一条被丢弃的 user 消息并从那里截断 (连带其后的 assistant/tool 消息)；
+    上下文中找不到对应内容时 (例如历史已被 /reset) 不做任何修改。
+    """
+    anchor = next((i for i, text in enumerate(dropped) if text.strip()), None)
+    if anchor is None:
+        return contexts
+    text = dropped[anchor].strip()
+    users = [i for i, msg in enumerate(contexts) if isinstance(msg, dict) and msg.get("role") == "user"]
+    # 锚点之后还有 len(dropped) - anchor - 1 条被丢弃的 user 消息，跳过它们，避免匹配到内容相同的后续轮次
+    for pos in range(len(users) - (len(dropped) - anchor), -1, -1):
+        if text in _context_text(contexts[users[pos]]):
+            # 锚点之前被丢弃的轮次没有文本 (例如纯图片)，它们紧挨在锚点之前
+            return contexts[:users[max(0, pos - anchor)]]
+    return contexts
+
+
+class _SessionState:
+    __slots__ = ("digests", "base", "llm_turns")
+
+    def __init__(self):
+        self.digests: list[str] = []
+        # digests[0] 在整个对话中的位置 (客户端从前面截断上下文时增大)
+        self.base = 0
+        # 已经写入 AstrBot 对话历史的轮次: user 消息在整个对话中的位置 -> 交给 AstrBot 的文本
+        self.llm_turns: dict[int, str] = {}
+
+
+class ConversationFingerprintIndex:
+    """
+    按会话记录客户端上一次发来的 messages 摘要，用于识别重新生成 / 编辑 / 分支。
+
+    客户端每次都会带上 messages，而适配器只把最后一条 user 消息交给 AstrBot。
+    客户端可能只发送最近的若干条消息 (上下文条数上限)，因此先把新请求的第一条消息对齐到上一次请求中的位置，
+    再比较之后的消息：如果新请求与上一次请求的公共部分没有覆盖上一次的末尾，说明客户端丢弃了后面的轮次
+    (重新生成会丢弃最后一轮，编辑或分支会丢弃更多)，这些轮次也应从 AstrBot 历史中回滚。
+    对不齐 (上下文窗口已经越过上一次的全部消息) 时无法判断，不做回滚。
+    """
+
+    def __init__(self, max_sessions: int = 1000):
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, _SessionState] = OrderedDict()
+
+    def observe(self, session_id: str, digests: list[str], turn_index: int) -> tuple[int, list[str]]:
+        """
+        记录本次请求，digests 为 message_digests(messages)，turn_index 为本次交给 AstrBot 的 user 消息下标。
+        返回 (本轮在整个对话中的位置, 需要从 AstrBot 历史中回滚的轮次的 user 文本 (按先后顺序))。
+        """
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = _SessionState()
+            self._sessions[session_id] = state
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+
+        dropped: list[str] = []
+        alignment = self._align(state.digests, digests, turn_index)
+        if alignment is not None:
+            shift, common = alignment
+            state.base += shift
+            cut = state.base + common
+            dropped = [state.llm_turns.pop(pos) for pos in sorted(p for p in state.llm_turns if p >= cut)]
+        elif state.digests:
+            # 对不齐：把本次请求接在上一次之后，已有的轮次保持不变
+            state.base += len(state.digests)
+
+        state.digests = digests
+        return state.base + turn_index, dropped
+
+    def mark_llm_turn(self, session_id: str, turn: int, text: str):
+        """ 该轮已得到 assistant 回复并会写入 AstrBot 对话历史 (由 on_llm_response 钩子调用)，turn 为 observe 返回的位置 """
+        state = self._sessions.get(session_id)
+        if state is not None:
+            state.llm_turns[turn] = text
+
+    @staticmethod
+    def _align(old: list[str], new: list[str], limit: int) -> tuple[int, int] | None:
+        """
+        找到 new[0] 在 old 中的位置 shift 以及从该位置开始的公共长度 common (不超过 limit)，
+        返回 (shift, common)；old 为空时返回 (0, 0)，对不齐时返回 None。
+        new[0] 在 old 中出现多次 (例如重复发送的同一句话) 时，取公共部分延伸到 old 中最远的位置，相同时取最靠前的。
+        """
+        if not old:
+            return 0, 0
+        if not new:
+            return None
+        best = None
+        for shift, digest in enumerate(old):
+            if digest != new[0]:
+                continue
+            upper = min(len(old) - shift, len(new), limit)
+            common = 0
+            while common < upper and old[shift + common] == new[common]:
+                common += 1
+            if best is None or shift + common > best[0] + best[1]:
+                best = (shift, common)
+        return best
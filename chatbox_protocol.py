@@ -0,0 +1,343 @@
+"""
+OpenAI 协议相关的纯函数和响应循环。
+
+本模块不依赖 AstrBot，既被适配器使用，也被独立运行的前端 worker 进程 (chatbox_worker.py) 使用。
+"""
+import asyncio
+import json
+import struct
+import time
+
+# --- IPC 帧: 4 字节大端长度 + JSON ---
+_FRAME_HEADER = struct.Struct(">I")
+
+
+def encode_frame(obj: dict) -> bytes:
+    data = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+    return _FRAME_HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader: asyncio.StreamReader) -> dict:
+    """ 读取一帧，连接关闭时抛出 asyncio.IncompleteReadError """
+    header = await reader.readexactly(_FRAME_HEADER.size)
+    (length,) = _FRAME_HEADER.unpack(header)
+    return json.loads(await reader.readexactly(length))
+
+
+def compact_request(body: dict, hasher=None) -> dict:
+    """
+    把 OpenAI 请求体精简为主进程需要的字段：最后一条 user 消息的内容 (parts)、它在 messages 中的下标 (turn)、
+    model、user 和 stream。hasher(messages) 不为空时附带对话指纹使用的消息摘要。请求体无效时抛出 ValueError。
+    """
+    messages = body.get("messages")
+    if not messages or not isinstance(messages, list):
+        raise ValueError("Missing 'messages' field")
+
+    turn = next(
+        (i for i in range(len(messages) - 1, -1, -1) if isinstance(messages[i], dict) and messages[i].get("role") == "user"),
+        None,
+    )
+    if turn is None:
+        raise ValueError("No 'user' role message found")
+
+    content = messages[turn].get("content")
+    parts = []
+    if isinstance(content, str):
+        parts.append({"type": "text", "text": content})
+    elif isinstance(content, list):
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "text":
+                parts.append({"type": "text", "text": part.get("text", "")})
+            elif part.get("type") == "image_url":
+                img_url = (part.get("image_url") or {}).get("url", "")
+                if img_url:
+                    parts.append({"type": "image_url", "image_url": {"url": img_url}})
+
+    if not parts:
+        raise ValueError("User message content is empty or unsupported")
+
+    request = {"parts": parts, "turn": turn, "stream": bool(body.get("stream", False))}
+    for key in ("model", "user"):
+        if key in body:
+            request[key] = body[key]
+    if hasher:
+        request["digests"] = hasher(messages)
+    return request
+
+
+def expand_request(request: dict) -> dict:
+    """ 把 compact_request 的结果还原为只包含最后一条 user 消息的 OpenAI 请求体 """
+    body = {"messages": [{"role": "user", "content": request["parts"]}], "stream": request.get("stream", False)}
+    for key in ("model", "user"):
+        if key in request:
+            body[key] = request[key]
+    return body
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+async def iter_jsonl_lines(chunks, max_line_bytes: int, max_upload_bytes: int):
+    """
+    把逐块到达的上传内容 (bytes 的异步迭代器) 切分为行，产出 (行号, 行内容)。
+    超过 max_line_bytes 的行产出 (行号, None)，其剩余部分直接丢弃，不会缓存在内存中；
+    累计超过 max_upload_bytes 时抛出 UploadTooLarge。
+    """
+    buf = bytearray()
+    total = 0
+    line_no = 0
+    discarding = False  # 正在跳过一个超长行的剩余部分
+
+    async for data in chunks:
+        total += len(data)
+        if total > max_upload_bytes:
+            raise UploadTooLarge(f"Upload exceeds {max_upload_bytes} bytes")
+        buf.extend(data)
+
+        start = 0
+        while (newline := buf.find(b"\n", start)) >= 0:
+            line = bytes(buf[start:newline])
+            start = newline + 1
+            if discarding:
+                discarding = False
+                continue
+            line_no += 1
+            yield line_no, (line if len(line) <= max_line_bytes else None)
+        del buf[:start]
+
+        if len(buf) > max_line_bytes:
+            if not discarding:
+                line_no += 1
+                yield line_no, None
+                discarding = True
+            buf.clear()
+
+    if buf and not discarding:
+        yield line_no + 1, bytes(buf)
+
+
+def format_as_openai_response(content: str, msg_id: str, model: str, finish_reason: str = "stop", tool_calls: list = None) -> dict:
+    message = {
+        "role": "assistant",
+        "content": content if not tool_calls else None,
+    }
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+
+    return {
+        "id": msg_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": message,
+                "finish_reason": finish_reason
+            }
+        ],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
+
+def format_as_openai_chunk(delta: dict, msg_id: str, model: str) -> dict:
+    choice_delta = {}
+    if "content" in delta:
+        choice_delta = {"role": "assistant", "content": delta["content"]}
+    elif "tool_calls" in delta:
+        choice_delta = {"role": "assistant", "tool_calls": delta["tool_calls"]}
+
+    finish_reason = delta.get("finish_reason")
+
+    return {
+        "id": msg_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "delta": choice_delta if choice_delta else {},
+                "logprobs": None,
+                "finish_reason": finish_reason
+            }
+        ]
+    }
+
+
+def compact_item(item):
+    """ 只保留回复块中的 delta / message 和 finish_reason，其余字段由 expand_item 在 worker 中补齐 """
+    if not isinstance(item, dict) or not item.get("choices"):
+        return item
+    choice = item["choices"][0]
+    if "delta" in choice:
+        return {"delta": choice["delta"], "finish_reason": choice.get("finish_reason")}
+    return {"message": choice.get("message") or {}, "finish_reason": choice.get("finish_reason")}
+
+
+def expand_item(item, msg_id: str, model: str):
+    if not isinstance(item, dict):
+        return item
+    if "delta" in item:
+        chunk = format_as_openai_chunk({}, msg_id, model)
+        chunk["choices"][0]["delta"] = item["delta"]
+        chunk["choices"][0]["finish_reason"] = item["finish_reason"]
+        return chunk
+    if "message" in item:
+        message = item["message"]
+        return format_as_openai_response(message.get("content"), msg_id, model, item["finish_reason"], message.get("tool_calls"))
+    return item
+
+
+def encode_sse(chunk: dict) -> bytes:
+    return f"data: {json.dumps(chunk)}\n\n".encode()
+
+
+async def collect_non_stream(queue: asyncio.Queue, message_id: str, timeout: float, aggregation_timeout: float, log) -> tuple[dict, int]:
+    """ 等待并聚合非流式回复，返回 (响应体, HTTP 状态码) """
+    final_response = None
+
+    # 嵌套函数，用于被 wait_for 包裹
+    async def _responder():
+        nonlocal final_response
+        # --- 1. 等待第一条消息 ---
+        # 这里的 queue.get() 受外层的 timeout 限制
+        try:
+            item = await queue.get()
+            if isinstance(item, dict):
+                final_response = item # 存储第一条消息
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 等待第一条消息时出错: {e}")
+            raise
+
+        # --- 2. 循环等待后续消息 (聚合) ---
+        try:
+            while True:
+                # 内层: 聚合超时 (例如 2s)
+                item = await asyncio.wait_for(queue.get(), timeout=aggregation_timeout)
+                if isinstance(item, dict):
+                    final_response = item # 持续覆盖，只保留最后一个聚合响应
+
+        except asyncio.TimeoutError:
+            # --- 正常退出 (聚合超时) ---
+            # 内层的 aggregation_timeout 触发，意味着Bot停止发送消息。
+            log.debug(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 聚合超时，准备发送回复。")
+            pass # 正常退出
+
+        except asyncio.CancelledError:
+            log.debug(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 内部循环被取消。")
+            raise
+
+    try:
+        # --- 外层: LLM总超时 ---
+        # 使用兼容的 asyncio.wait_for 替代 asyncio.timeout
+        await asyncio.wait_for(_responder(), timeout=timeout)
+
+    except asyncio.TimeoutError:
+        # --- 异常退出 (LLM总超时) ---
+        log.warning(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} *总超时* (LLM超时)。")
+        if not final_response:
+            return {"error": f"Request timed out after {timeout}s (no first reply)"}, 504
+        log.warning(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 返回*部分*聚合回复。")
+
+    except Exception as e:
+        log.error(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 发生未知错误: {e}")
+        if not final_response:
+            return {"error": "Internal server error"}, 500
+
+    # --- 统一出口 ---
+    if final_response:
+        return final_response, 200
+    else:
+        log.warning(f"【Chatbox 适配器】: (Non-Stream) 队列 {message_id} 未收到任何有效回复。")
+        return {"error": "No response from bot"}, 500
+
+
+async def pump_stream(queue: asyncio.Queue, write, message_id: str, timeout: float, aggregation_timeout: float, log):
+    """ 把队列中的块以 SSE 写给客户端 (write 为 response.write)，结束时总会尝试发送 'stop' 和 [DONE] """
+    model_name = "astrbot-stream" # 默认模型名
+
+    # 嵌套函数，用于被 wait_for 包裹
+    async def _responder():
+        nonlocal model_name
+        # --- 1. 等待第一条 *有效* 消息 ---
+        try:
+            while True:
+                # 这里的 queue.get() 受外层的 timeout 限制
+                chunk = await queue.get()
+                if chunk.get("model"):
+                    model_name = chunk.get("model")
+
+                # [修复] 只有在收到 *非空* 块时才算 "第一条消息"
+                # 如果是空的心跳块, (delta == {})，则继续循环
+                if not (chunk.get("choices") and chunk["choices"][0].get("delta") == {}):
+                    # 这是一个有效块 (文本, tool_call, 或 stop)
+                    await write(encode_sse(chunk))
+                    # 收到有效块，跳出Step 1的循环, 进入Step 2
+                    break
+                else:
+                    # 是空块 (delta == {})，忽略并继续等待第一条 *有效* 消息
+                    log.debug("【Chatbox 适配器】: (Stream) 收到并忽略了心跳空块")
+
+        except asyncio.CancelledError:
+            raise # 如果被取消，直接抛出
+        except Exception as e:
+            log.error(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 等待第一条消息时出错: {e}")
+            raise # 抛出错误到外层 catch
+
+        # --- 2. 循环等待后续消息 (聚合) ---
+        try:
+            while True:
+                # 内层: 聚合超时 (例如 3s)
+                chunk = await asyncio.wait_for(queue.get(), timeout=aggregation_timeout)
+
+                # (K线图的第二条消息会在这里被捕获)
+                if chunk.get("choices") and chunk["choices"][0].get("delta") == {}:
+                    continue # 跳过后续可能的心跳块
+
+                await write(encode_sse(chunk))
+
+        except asyncio.TimeoutError:
+            # --- 正常退出 (聚合超时) ---
+            log.debug(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 聚合超时，正常关闭流。")
+            pass # 正常退出
+
+        except asyncio.CancelledError:
+            log.debug(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 内部循环被取消。")
+            raise
+
+    try:
+        # --- 外层: LLM总超时 ---
+        await asyncio.wait_for(_responder(), timeout=timeout)
+
+    except asyncio.TimeoutError:
+        # --- 异常退出 (LLM总超时) ---
+        log.warning(f"【Chatbox 适配器】: (Stream) 队列 {message_id} *总超时* (LLM超时)。")
+        # 同样进入 finally 块发送 [DONE]
+
+    except Exception as e:
+        log.error(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 发生未知错误: {e} (in _responder: {type(e)})")
+        # 同样进入 finally 块发送 [DONE]
+
+    finally:
+        # --- 统一出口：必须关闭客户端流 ---
+        try:
+            log.debug(f"【Chatbox 适配器】: (Stream) 队列 {message_id} 正在发送 'stop' 和 [DONE]...")
+            # 1. 发送 'stop' 信号块
+            stop_chunk = format_as_openai_chunk(
+                {"finish_reason": "stop"},
+                message_id,
+                model_name
+            )
+            await write(encode_sse(stop_chunk))
+
+            # 2. 发送 [DONE] 终止信号
+            await write(b"data: [DONE]\n\n")
+
+        except Exception as e:
+            log.warning(f"【Chatbox 适配器】: (Stream) 写入最终 [DONE] 失败 (客户端可能已提前断开): {e}")
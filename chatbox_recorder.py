@@ -0,0 +1,135 @@
+import json
+import logging
+import queue
+import re
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from astrbot.api import logger
+from astrbot.api.message_components import Image, Plain
+
+# 这些字段无论出现在请求体的哪一层，都会被替换为 "***"
+REDACT_KEYS = {
+    "api_key",
+    "authorization",
+    "password",
+    "secret",
+    "token",
+    "access_key",
+    "secret_key",
+}
+REDACTED = "***"
+
+# 预签名 URL 中的签名参数
+_SIGNATURE_RE = re.compile(r"(X-Amz-(?:Signature|Credential|Security-Token)=)[^&\s)]+", re.IGNORECASE)
+
+
+def redact(value):
+    """ 递归脱敏：去掉密钥类字段、data: URL 中的 base64 数据和预签名 URL 中的签名 """
+    if isinstance(value, dict):
+        return {
+            k: (REDACTED if str(k).lower() in REDACT_KEYS else redact(v))
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        if value.startswith("data:") and ";base64," in value:
+            head, _, data = value.partition(";base64,")
+            return f"{head};base64,<{len(data)} bytes>"
+        return _SIGNATURE_RE.sub(r"\1" + REDACTED, value)
+    return value
+
+
+def dump_chain(chain: list) -> list:
+    """ 把 build_abm 产出的消息链转为可序列化的精简结构 """
+    dumped = []
+    for comp in chain:
+        if isinstance(comp, Plain):
+            dumped.append({"type": "Plain", "text": comp.text})
+        elif isinstance(comp, Image):
+            dumped.append({"type": "Image", "file": redact(comp.file or "")})
+        else:
+            dumped.append({"type": type(comp).__name__})
+    return dumped
+
+
+class TrafficRecorder:
+    """
+    流量录制器 (可选)。
+
+    每行一条 JSON 记录，按大小滚动:
+      {"t": "req",  "id": ..., "ts": ..., "stream": ..., "model": ..., "session_id": ..., "chain": [...], "body": {...}}
+      {"t": "send", "id": ..., "dt": ..., "content": ...}
+      {"t": "end",  "id": ..., "dt": ...}
+    dt 为距离请求进入适配器的秒数，可由 chatbox_replay.py 按原速或加速回放。
+    """
+
+    def __init__(self, path: str, max_bytes: int, backup_count: int):
+        self.path = path
+        self._started: dict[str, float] = {}
+
+        # 使用独立的 logger + RotatingFileHandler 负责滚动，避免自己管理文件句柄。
+        # 事件循环上只把记录放进队列，写盘、flush 和滚动都在 QueueListener 的后台线程中完成，
+        # 避免录制本身给被测量的请求增加延迟
+        self._file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self._file_handler.setFormatter(logging.Formatter("%(message)s"))
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        self._listener = QueueListener(records, self._file_handler)
+        self._listener.start()
+
+        self._writer = logging.getLogger(f"chatbox_recorder.{path}")
+        self._writer.setLevel(logging.INFO)
+        self._writer.propagate = False
+        for handler in list(self._writer.handlers):
+            # 清理插件重载前遗留的 handler
+            self._writer.removeHandler(handler)
+        self._writer.addHandler(QueueHandler(records))
+
+    def _write(self, record: dict):
+        try:
+            self._writer.info(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        except Exception as e:
+            logger.warning(f"【Chatbox 录制】: 写入录制记录失败: {e}")
+
+    def record_request(self, abm, model_name: str, is_stream: bool):
+        self._started[abm.message_id] = time.monotonic()
+        self._write({
+            "t": "req",
+            "id": abm.message_id,
+            "ts": round(time.time(), 3),
+            "stream": is_stream,
+            "model": model_name,
+            "session_id": abm.session_id,
+            "message_str": abm.message_str,
+            "chain": dump_chain(abm.message),
+            "body": redact(abm.raw_message),
+        })
+
+    def record_send(self, message_id: str, content: str):
+        started = self._started.get(message_id)
+        if started is None:
+            return
+        self._write({
+            "t": "send",
+            "id": message_id,
+            "dt": round(time.monotonic() - started, 3),
+            "content": redact(content),
+        })
+
+    def record_end(self, message_id: str):
+        started = self._started.pop(message_id, None)
+        if started is None:
+            return
+        self._write({
+            "t": "end",
+            "id": message_id,
+            "dt": round(time.monotonic() - started, 3),
+        })
+
+    def close(self):
+        for handler in list(self._writer.handlers):
+            self._writer.removeHandler(handler)
+        # stop() 会先写完队列中剩余的记录
+        self._listener.stop()
+        self._file_handler.close()
@@ -0,0 +1,233 @@
+"""
+Chatbox 适配器流量回放工具。
+
+读取 chatbox_recorder 录制的 JSONL 文件 (含滚动产生的 .1/.2 ... 文件)，支持两种模式:
+
+  serve: 启动真实的 ChatboxAdapter，用一个按录制时间线调用 ChatboxEvent.send 的桩流水线代替 AstrBot 流水线 + LLM。
+         需要当前 Python 环境中安装了 AstrBot (只导入，不运行)，可以用 --config 覆盖适配器配置 (例如 frontend_workers)
+      python chatbox_replay.py serve chatbox_traffic.jsonl --port 8081 --speed 2 --config replay.json
+
+  drive: 按录制时的到达间隔把请求重新发往某个地址 (serve 启动的适配器或线上适配器)，并统计首字节/总延迟，仅需 aiohttp
+      python chatbox_replay.py drive chatbox_traffic.jsonl --url http://127.0.0.1:8081 --api-key xxx --speed 2
+
+--speed 为加速倍数 (1 为原速，0 表示不等待)。
+"""
+import argparse
+import asyncio
+import copy
+import glob
+import importlib
+import importlib.machinery
+import importlib.util
+import json
+import os
+import re
+import sys
+import time
+
+from aiohttp import ClientResponseError, ClientSession, ClientTimeout
+
+
+def load_recordings(path: str) -> list[dict]:
+    """ 把 req/send/end 记录按请求 id 合并，按请求到达时间排序 """
+    # RotatingFileHandler 的滚动文件中 .N 越大越旧，需先读最旧的
+    rotated = [f for f in glob.glob(f"{glob.escape(path)}.*") if f.rsplit(".", 1)[-1].isdigit()]
+    files = sorted(rotated, key=lambda f: int(f.rsplit(".", 1)[-1]), reverse=True) + [path]
+    by_id: dict[str, dict] = {}
+    for file in files:
+        with open(file, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                rec = json.loads(line)
+                if rec["t"] == "req":
+                    by_id[rec["id"]] = {**rec, "sends": [], "end": None}
+                elif rec["id"] in by_id:
+                    if rec["t"] == "send":
+                        by_id[rec["id"]]["sends"].append(rec)
+                    elif rec["t"] == "end":
+                        by_id[rec["id"]]["end"] = rec["dt"]
+    return sorted(by_id.values(), key=lambda r: r["ts"])
+
+
+# 录制时 data: 图片被替换为 "data:image/png;base64,<N bytes>"，回放时换成一张有效的 1x1 PNG
+_REDACTED_DATA_URL = re.compile(r"^data:[^;,]*;base64,<\d+ bytes>$")
+STUB_IMAGE_DATA_URL = (
+    "data:image/png;base64,"
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+
+def restore_redacted_images(body: dict) -> dict:
+    """ 把请求体中被脱敏的 data: 图片换成有效的桩图片，保证图片轮次也能被真实适配器接受 """
+    body = copy.deepcopy(body)
+    for msg in body.get("messages", []):
+        content = msg.get("content") if isinstance(msg, dict) else None
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            image_url = part.get("image_url") if isinstance(part, dict) else None
+            if isinstance(image_url, dict) and _REDACTED_DATA_URL.match(image_url.get("url", "")):
+                image_url["url"] = STUB_IMAGE_DATA_URL
+    return body
+
+
+def _scaled(seconds: float, speed: float) -> float:
+    return seconds / speed if speed > 0 else 0.0
+
+
+def load_adapter_module():
+    """ 以包的形式导入插件目录 (插件模块之间使用相对导入)，返回 chatbox_adapter 模块 """
+    package = "chatbox_replay_plugin"
+    spec = importlib.machinery.ModuleSpec(package, None, is_package=True)
+    spec.submodule_search_locations = [os.path.dirname(os.path.abspath(__file__))]
+    sys.modules[package] = importlib.util.module_from_spec(spec)
+    return importlib.import_module(f"{package}.chatbox_adapter")
+
+
+class ReplayPipeline:
+    """
+    桩流水线：代替 AstrBot 消费适配器提交到 event_queue 的事件，
+    按录制的 send 时间线调用真实的 ChatboxEvent.send，因此聚合、SSE、调度器、worker 等适配器代码都会被执行。
+    按消息文本匹配录制，匹配不到时按顺序轮流使用。
+    """
+
+    def __init__(self, recordings: list[dict], speed: float, make_chain):
+        self.recordings = recordings
+        self.speed = speed
+        self.make_chain = make_chain  # text -> MessageChain
+        self.by_text = {r.get("message_str", ""): r for r in recordings}
+        self._next = 0
+        self._tasks: set[asyncio.Task] = set()
+
+    def pick(self, message_str: str) -> dict:
+        if message_str in self.by_text:
+            return self.by_text[message_str]
+        rec = self.recordings[self._next % len(self.recordings)]
+        self._next += 1
+        return rec
+
+    async def consume(self, event_queue: asyncio.Queue):
+        while True:
+            event = await event_queue.get()
+            task = asyncio.create_task(self._replay(event))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _replay(self, event):
+        rec = self.pick(event.message_str)
+        started = time.monotonic()
+        for send in rec["sends"]:
+            delay = _scaled(send["dt"], self.speed) - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await event.send(self.make_chain(send["content"]))
+            except Exception as e:
+                print(f"回放 {rec['id']} 的输出失败: {e}")
+
+
+async def serve(recordings: list[dict], host: str, port: int, api_key: str | None, speed: float, config_path: str | None):
+    adapter_module = load_adapter_module()
+    from astrbot.api.event import MessageChain
+    from astrbot.api.message_components import Plain
+
+    config = dict(adapter_module.DEFAULT_CONFIG)
+    if config_path:
+        with open(config_path, encoding="utf-8") as f:
+            config.update(json.load(f))
+    # 回放时不再录制
+    config.update(host=host, port=port, record_enable=False)
+    if api_key is not None:
+        config["api_key"] = api_key
+
+    event_queue: asyncio.Queue = asyncio.Queue()
+    adapter = adapter_module.ChatboxAdapter(config, {"id": "chatbox_replay"}, event_queue)
+    pipeline = ReplayPipeline(recordings, speed, lambda text: MessageChain(chain=[Plain(text=text)]))
+    consumer = asyncio.create_task(pipeline.consume(event_queue))
+    print(f"适配器已在 http://{host}:{port} 上启动，桩流水线共 {len(recordings)} 条录制，速度 x{speed}")
+    try:
+        await adapter.run()
+    finally:
+        consumer.cancel()
+
+
+async def _drive_one(session: ClientSession, url: str, headers: dict, rec: dict) -> tuple[float, float]:
+    started = time.monotonic()
+    first_byte = None
+    body = restore_redacted_images(rec["body"])
+    async with session.post(f"{url}/v1/chat/completions", json=body, headers=headers) as resp:
+        # 401 / 4xx / 5xx 计为失败，不计入延迟统计
+        resp.raise_for_status()
+        async for _ in resp.content.iter_any():
+            if first_byte is None:
+                first_byte = time.monotonic() - started
+    total = time.monotonic() - started
+    return (first_byte if first_byte is not None else total), total
+
+
+async def drive(recordings: list[dict], url: str, api_key: str, speed: float, timeout: float):
+    headers = {"Authorization": f"Bearer {api_key}"}
+    ts0 = recordings[0]["ts"]
+    started = time.monotonic()
+
+    async with ClientSession(timeout=ClientTimeout(total=timeout)) as session:
+        async def _scheduled(rec: dict):
+            delay = _scaled(rec["ts"] - ts0, speed) - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return await _drive_one(session, url.rstrip("/"), headers, rec)
+
+        results = await asyncio.gather(*(_scheduled(r) for r in recordings), return_exceptions=True)
+
+    ok = [r for r in results if not isinstance(r, BaseException)]
+    failed = len(results) - len(ok)
+    print(f"共 {len(results)} 个请求，成功 {len(ok)}，失败 {failed}")
+    errors: dict[str, int] = {}
+    for r in results:
+        if isinstance(r, BaseException):
+            reason = f"HTTP {r.status}" if isinstance(r, ClientResponseError) else type(r).__name__
+            errors[reason] = errors.get(reason, 0) + 1
+    for reason, count in sorted(errors.items()):
+        print(f"  失败原因 {reason}: {count}")
+    if not ok:
+        return
+    for label, values in (("首字节", sorted(r[0] for r in ok)), ("总耗时", sorted(r[1] for r in ok))):
+        p50 = values[len(values) // 2]
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        print(f"{label}: p50={p50:.3f}s p95={p95:.3f}s max={values[-1]:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chatbox 适配器流量回放工具")
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    p_serve = sub.add_parser("serve", help="启动真实适配器，用按录制时间线回放的桩流水线代替 AstrBot")
+    p_serve.add_argument("recording")
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=8081)
+    p_serve.add_argument("--api-key", default=None, help="覆盖配置中的 api_key")
+    p_serve.add_argument("--speed", type=float, default=1.0)
+    p_serve.add_argument("--config", default=None, help="JSON 文件，覆盖适配器默认配置")
+
+    p_drive = sub.add_parser("drive", help="按录制的到达间隔重放请求并统计延迟")
+    p_drive.add_argument("recording")
+    p_drive.add_argument("--url", default="http://127.0.0.1:8080")
+    p_drive.add_argument("--api-key", default="")
+    p_drive.add_argument("--speed", type=float, default=1.0)
+    p_drive.add_argument("--timeout", type=float, default=600.0)
+
+    args = parser.parse_args()
+    recordings = load_recordings(args.recording)
+    if not recordings:
+        parser.error(f"{args.recording} 中没有可回放的请求记录")
+
+    if args.mode == "serve":
+        asyncio.run(serve(recordings, args.host, args.port, args.api_key, args.speed, args.config))
+    else:
+        asyncio.run(drive(recordings, args.url, args.api_key, args.speed, args.timeout))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+from collections import deque
+from typing import Callable
+
+from astrbot.api import logger
+
+
+class Lane:
+    """ 一条优先级通道：按指令前缀 / API Key / 用户 ID 匹配请求 """
+
+    def __init__(self, name: str, weight: float = 1.0, max_concurrency: int = 0,
+                 command_prefixes: list | None = None, api_keys: list | None = None, user_ids: list | None = None):
+        self.name = name
+        self.weight = weight if weight > 0 else 1.0
+        self.max_concurrency = max_concurrency  # 0 表示不限制
+        self.command_prefixes = tuple(p for p in (command_prefixes or []) if p)
+        self.api_keys = {k for k in (api_keys or []) if k}
+        self.user_ids = {str(u) for u in (user_ids or []) if u}
+
+        self.waiting: deque[str] = deque()
+        self.inflight = 0
+        # 步幅调度 (stride scheduling) 的虚拟时间，每出队一次前进 1/weight
+        self.pass_value = 0.0
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "Lane":
+        return cls(
+            name=str(conf.get("name") or "lane"),
+            weight=float(conf.get("weight", 1)),
+            max_concurrency=int(conf.get("max_concurrency", 0)),
+            command_prefixes=conf.get("command_prefixes"),
+            api_keys=conf.get("api_keys"),
+            user_ids=conf.get("user_ids"),
+        )
+
+    def matches(self, message_str: str, api_key: str | None, user_id: str) -> bool:
+        if self.command_prefixes and message_str.lstrip().startswith(self.command_prefixes):
+            return True
+        if api_key and api_key in self.api_keys:
+            return True
+        return user_id in self.user_ids
+
+    def has_capacity(self) -> bool:
+        return not self.max_concurrency or self.inflight < self.max_concurrency
+
+
+class EventScheduler:
+    """
+    位于 commit_event 之前的调度器。
+
+    请求按配置顺序匹配到第一条通道 (都不匹配则进入默认通道)，各通道有独立的并发上限；
+    多条通道同时有请求排队时按权重做加权公平出队，避免一批长 LLM 请求阻塞 /ping 等轻量指令。
+    请求结束 (release) 后释放并发名额并继续出队。
+    """
+
+    def __init__(self, lanes: list[Lane], default_lane: Lane, max_inflight: int, commit: Callable):
+        self.lanes = lanes
+        self.default_lane = default_lane
+        self.all_lanes = [*lanes, default_lane]
+        self.max_inflight = max_inflight  # 0 表示不限制
+        self.commit = commit
+
+        self.inflight = 0
+        self.virtual_time = 0.0
+        self._events: dict[str, object] = {}   # 排队中的 message_id -> event
+        self._lane_of: dict[str, Lane] = {}    # 排队中或已提交的 message_id -> 所属通道
+
+    def classify(self, message_str: str, api_key: str | None, user_id: str) -> Lane:
+        for lane in self.lanes:
+            if lane.matches(message_str, api_key, user_id):
+                return lane
+        return self.default_lane
+
+    def submit(self, message_id: str, event, lane: Lane):
+        if not lane.waiting:
+            # 通道从空闲变为活跃时不能带着积攒的“欠额”插队
+            lane.pass_value = max(lane.pass_value, self.virtual_time)
+        lane.waiting.append(message_id)
+        self._events[message_id] = event
+        self._lane_of[message_id] = lane
+        self._pump()
+        if message_id in self._events:
+            logger.debug(f"【Chatbox 调度】: 请求 {message_id} 在通道 '{lane.name}' 排队 (排队 {len(lane.waiting)}，进行中 {lane.inflight})")
+
+    def release(self, message_id: str):
+        lane = self._lane_of.pop(message_id, None)
+        if lane is None:
+            return
+        if self._events.pop(message_id, None) is None:
+            # 已提交的请求结束，释放名额
+            lane.inflight -= 1
+            self.inflight -= 1
+        # 仍在排队的请求 (例如客户端超时) 直接丢弃，出队时会跳过
+        self._pump()
+
+    def _pump(self):
+        while not self.max_inflight or self.inflight < self.max_inflight:
+            lane = self._pick_lane()
+            if lane is None:
+                return
+            message_id = lane.waiting.popleft()
+            event = self._events.pop(message_id)
+
+            lane.inflight += 1
+            self.inflight += 1
+            lane.pass_value += 1.0 / lane.weight
+            self.virtual_time = max(self.virtual_time, lane.pass_value - 1.0 / lane.weight)
+            self.commit(event)
+
+    def _pick_lane(self) -> Lane | None:
+        best = None
+        for lane in self.all_lanes:
+            # 先清理队首已取消的请求
+            while lane.waiting and lane.waiting[0] not in self._events:
+                lane.waiting.popleft()
+            if lane.waiting and lane.has_capacity():
+                if best is None or lane.pass_value < best.pass_value:
+                    best = lane
+        return best
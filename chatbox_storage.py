@@ -0,0 +1,253 @@
+import asyncio
+import datetime
+import re
+import time
+import uuid
+
+try:
+    from minio.commonconfig import ENABLED, Filter
+    from minio.deleteobjects import DeleteObject
+    from minio.lifecycleconfig import Expiration, LifecycleConfig, Rule
+except ImportError:
+    # 未安装 minio 时适配器不会创建 ImageLifecycleManager
+    pass
+
+from astrbot.api import logger
+
+OBJECT_PREFIX = "chatbox_adapter/"
+LIFECYCLE_RULE_ID = "chatbox-adapter-expire"
+DELETE_BATCH_SIZE = 1000  # S3 DeleteObjects 单次最多 1000 个
+
+# chatbox_adapter/YYYY/MM/DD/{uuid}/{file}
+_PARTITION_RE = re.compile(r"^" + re.escape(OBJECT_PREFIX) + r"(\d{4})/(\d{2})/(\d{2})/")
+_YEAR_DIR_RE = re.compile(r"^" + re.escape(OBJECT_PREFIX) + r"\d{4}/$")
+
+
+def build_object_name(file_name: str, now: datetime.datetime | None = None) -> str:
+    """ 按上传日期 (UTC) 分区的对象名，便于按日期整体过期 """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return f"{OBJECT_PREFIX}{now:%Y/%m/%d}/{uuid.uuid4()}/{file_name}"
+
+
+def partition_date(object_name: str) -> datetime.date | None:
+    match = _PARTITION_RE.match(object_name)
+    if not match:
+        return None
+    try:
+        return datetime.date(*(int(g) for g in match.groups()))
+    except ValueError:
+        return None
+
+
+class ImageLifecycleManager:
+    """
+    管理适配器上传到 MinIO 的图片对象的生命周期。
+
+    mode = "sweeper": 后台任务定期扫描 chatbox_adapter/ 前缀，批量删除超过保留期的对象
+    mode = "rule":    在存储桶上安装按前缀过期的生命周期规则，由 MinIO 自行删除；后台任务只统计
+    retention_days 为 0 时不删除任何对象，后台任务仍会定期扫描以更新统计。
+    """
+
+    def __init__(self, client, bucket: str, retention_days: int, mode: str, interval_hours: float):
+        self.client = client
+        self.bucket = bucket
+        self.retention_days = retention_days
+        self.mode = mode
+        self.interval = max(interval_hours, 0.1) * 3600
+        self._task: asyncio.Task | None = None
+        # 已结束 (不会再有新上传) 且未过期的日期分区 -> (对象数, 字节数)，避免每次扫描都递归列出
+        self._day_stats: dict[str, tuple[int, int]] = {}
+
+        # --- 指标 ---
+        self.object_count = 0           # 最近一次扫描时的对象数
+        self.stored_bytes = 0           # 最近一次扫描时的总字节数
+        self.last_scan: float | None = None
+        self.deleted_objects = 0        # 累计删除的对象数
+        self.deleted_bytes = 0
+        self.uploaded_objects = 0       # 本次启动以来上传的对象数
+        self.uploaded_bytes = 0
+
+    def record_upload(self, size: int):
+        self.uploaded_objects += 1
+        self.uploaded_bytes += size
+        # 在两次扫描之间保持指标大致准确
+        self.object_count += 1
+        self.stored_bytes += size
+
+    def stats(self) -> dict:
+        return {
+            "bucket": self.bucket,
+            "prefix": OBJECT_PREFIX,
+            "retention_days": self.retention_days,
+            "mode": self.mode,
+            "object_count": self.object_count,
+            "stored_bytes": self.stored_bytes,
+            "last_scan": self.last_scan,
+            "deleted_objects": self.deleted_objects,
+            "deleted_bytes": self.deleted_bytes,
+            "uploaded_objects": self.uploaded_objects,
+            "uploaded_bytes": self.uploaded_bytes,
+        }
+
+    def install_lifecycle_rule(self):
+        """ 安装 (或更新) 过期规则，保留存储桶上其它 ID 的规则 """
+        existing = self.client.get_bucket_lifecycle(self.bucket)
+        rules = [r for r in (existing.rules if existing else []) if r.rule_id != LIFECYCLE_RULE_ID]
+        rules.append(Rule(
+            ENABLED,
+            rule_filter=Filter(prefix=OBJECT_PREFIX),
+            rule_id=LIFECYCLE_RULE_ID,
+            expiration=Expiration(days=self.retention_days),
+        ))
+        self.client.set_bucket_lifecycle(self.bucket, LifecycleConfig(rules))
+        logger.info(f"【Chatbox MinIO】: 已在存储桶 '{self.bucket}' 上安装生命周期规则，{OBJECT_PREFIX} 下的对象 {self.retention_days} 天后过期。")
+
+    def remove_lifecycle_rule(self):
+        """ 移除本适配器安装的过期规则 (保留天数为 0 或改回 sweeper 模式时)，保留存储桶上其它 ID 的规则 """
+        existing = self.client.get_bucket_lifecycle(self.bucket)
+        if not existing or not any(r.rule_id == LIFECYCLE_RULE_ID for r in existing.rules):
+            return
+        rules = [r for r in existing.rules if r.rule_id != LIFECYCLE_RULE_ID]
+        if rules:
+            self.client.set_bucket_lifecycle(self.bucket, LifecycleConfig(rules))
+        else:
+            self.client.delete_bucket_lifecycle(self.bucket)
+        logger.info(f"【Chatbox MinIO】: 已移除存储桶 '{self.bucket}' 上的生命周期规则 {LIFECYCLE_RULE_ID}。")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                # minio 客户端是同步的，放到线程中执行，避免阻塞事件循环
+                await asyncio.to_thread(self.sweep)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"【Chatbox MinIO】: 清理过期图片时出错: {e}")
+            await asyncio.sleep(self.interval)
+
+    def _list_children(self, prefix: str) -> tuple[list[str], list]:
+        """ 非递归列出 prefix 下的子目录和直接位于其下的对象 """
+        dirs, objects = [], []
+        for obj in self.client.list_objects(self.bucket, prefix=prefix, recursive=False):
+            if obj.is_dir:
+                dirs.append(obj.object_name)
+            else:
+                objects.append(obj)
+        return dirs, objects
+
+    def sweep(self):
+        """
+        扫描一次前缀：统计对象数和字节数，sweeper 模式下批量删除过期对象。
+
+        按 年/月/日 逐级列出目录：过期的日期分区整体删除；已结束且未过期的日期分区使用缓存的统计，
+        因此只有最近的分区、过期分区和旧版 chatbox_adapter/{uuid}/ 布局 (没有日期分区，按修改时间判断) 需要递归列出。
+        """
+        delete = self.mode == "sweeper" and self.retention_days > 0
+        # sweep 在线程中运行，扫描期间事件循环上的 record_upload 仍会累加；
+        # 记下扫描开始时的上传计数，结束时把期间新增的上传补回统计，而不是直接覆盖掉
+        uploaded_objects, uploaded_bytes = self.uploaded_objects, self.uploaded_bytes
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cutoff = now - datetime.timedelta(days=self.retention_days)
+        # 早于此日期的分区不会再有新上传
+        settled = (now - datetime.timedelta(days=1)).date()
+
+        count = size = deleted = deleted_size = 0
+        batch: dict[str, int] = {}  # 待删除的对象名 -> 字节数
+
+        def _flush():
+            nonlocal count, size, deleted, deleted_size
+            failed = set()
+            for err in self.client.remove_objects(self.bucket, [DeleteObject(name) for name in batch]):
+                logger.warning(f"【Chatbox MinIO】: 删除对象 {err.name} 失败: {err.message}")
+                failed.add(err.name)
+            for name, obj_size in batch.items():
+                if name in failed:
+                    # 删除失败的对象仍然占用空间
+                    count += 1
+                    size += obj_size
+                else:
+                    deleted += 1
+                    deleted_size += obj_size
+            batch.clear()
+
+        def _take(obj, expired: bool) -> tuple[int, int]:
+            """ 过期则加入删除批次，否则计入统计 """
+            if delete and expired:
+                batch[obj.object_name] = obj.size or 0
+                if len(batch) >= DELETE_BATCH_SIZE:
+                    _flush()
+                return 0, 0
+            return 1, obj.size or 0
+
+        def _scan(prefix: str, expired=None) -> tuple[int, int]:
+            """ 递归扫描一个前缀；expired 为 None 时按修改时间判断 (旧版布局) """
+            kept = kept_size = 0
+            for obj in self.client.list_objects(self.bucket, prefix=prefix, recursive=True):
+                is_expired = expired if expired is not None else (
+                    obj.last_modified is not None and obj.last_modified < cutoff
+                )
+                n, n_size = _take(obj, is_expired)
+                kept += n
+                kept_size += n_size
+            return kept, kept_size
+
+        day_stats: dict[str, tuple[int, int]] = {}
+        year_dirs, top_objects = self._list_children(OBJECT_PREFIX)
+        for obj in top_objects:
+            n, n_size = _take(obj, obj.last_modified is not None and obj.last_modified < cutoff)
+            count += n
+            size += n_size
+
+        for year_dir in year_dirs:
+            if not _YEAR_DIR_RE.match(year_dir):
+                n, n_size = _scan(year_dir)
+                count += n
+                size += n_size
+                continue
+            for month_dir in self._list_children(year_dir)[0]:
+                day_dirs, stray = self._list_children(month_dir)
+                for obj in stray:
+                    n, n_size = _take(obj, obj.last_modified is not None and obj.last_modified < cutoff)
+                    count += n
+                    size += n_size
+                for day_dir in day_dirs:
+                    day = partition_date(day_dir)
+                    if day is None:
+                        n, n_size = _scan(day_dir)
+                    else:
+                        expired = self.retention_days > 0 and day < cutoff.date()
+                        cacheable = not expired and day < settled
+                        if cacheable and day_dir in self._day_stats:
+                            n, n_size = self._day_stats[day_dir]
+                        else:
+                            n, n_size = _scan(day_dir, expired)
+                        if cacheable:
+                            day_stats[day_dir] = (n, n_size)
+                    count += n
+                    size += n_size
+        if batch:
+            _flush()
+
+        self._day_stats = day_stats
+        self.object_count = count + (self.uploaded_objects - uploaded_objects)
+        self.stored_bytes = size + (self.uploaded_bytes - uploaded_bytes)
+        self.deleted_objects += deleted
+        self.deleted_bytes += deleted_size
+        self.last_scan = time.time()
+        logger.info(
+            f"【Chatbox MinIO】: 扫描完成，{OBJECT_PREFIX} 下共 {count} 个对象 / {size} 字节"
+            + (f"，本次删除 {deleted} 个过期对象" if delete else "")
+        )
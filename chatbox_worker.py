@@ -0,0 +1,267 @@
+"""
+Chatbox 适配器 HTTP 前端 worker 进程 (由适配器在 frontend_workers > 0 时启动，不要手动运行)。
+
+每个 worker 在共享端口 (SO_REUSEPORT) 上接受连接，负责 HTTP 解析、鉴权、JSON 解码和 SSE 编码，
+并在本进程内提取最后一条 user 消息 (以及对话指纹的消息摘要)，只把精简后的请求通过 Unix socket 转发给
+AstrBot 主进程；主进程把精简的回复块 (delta / message) 通过同一连接发回，由 worker 补齐成完整的 OpenAI 响应。
+
+IPC 帧 (见 chatbox_protocol.encode_frame):
+  主进程 -> worker: {"op": "config", ...}
+                    {"op": "accepted", "rid", "message_id", "model"} / {"op": "error", "rid", "status", "error"}
+                    {"op": "item", "message_id", "item"}    item 见 chatbox_protocol.compact_item
+  worker -> 主进程: {"op": "req", "rid", "request", "api_key"}    request 见 chatbox_protocol.compact_request
+                    {"op": "done", "message_id"}
+
+其它接口 (批量、存储统计等) 由 worker 原样转发到主进程的内部 HTTP 监听 (config 帧中的 proxy_path)，鉴权由主进程完成。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+from aiohttp import web
+
+# 作为脚本运行时，插件目录就是 sys.path[0]
+from chatbox_fingerprint import message_digests
+from chatbox_protocol import (
+    collect_non_stream,
+    compact_request,
+    encode_frame,
+    expand_item,
+    format_as_openai_chunk,
+    pump_stream,
+    read_frame,
+)
+
+# 转发时不能透传的逐跳头部
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade", "host",
+}
+
+logger = logging.getLogger("chatbox_worker")
+
+
+class FrontendWorker:
+    def __init__(self, worker_id: int, ipc_path: str):
+        self.worker_id = worker_id
+        self.ipc_path = ipc_path
+        self.config: dict = {}
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self._next_rid = 0
+        self._accepting: dict[int, asyncio.Future] = {}
+        self.queues: dict[str, asyncio.Queue] = {}
+        self.models: dict[str, str] = {}
+        self.proxy_session: aiohttp.ClientSession | None = None
+
+    async def send(self, obj: dict):
+        self.writer.write(encode_frame(obj))
+        await self.writer.drain()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.ipc_path)
+        frame = await read_frame(self.reader)
+        if frame.get("op") != "config":
+            raise RuntimeError(f"unexpected handshake frame: {frame.get('op')}")
+        self.config = frame
+
+    async def read_loop(self):
+        """ 按顺序处理主进程发来的帧，保证 accepted 一定先于该请求的 item 被处理 """
+        while True:
+            frame = await read_frame(self.reader)
+            op = frame.get("op")
+            if op == "item":
+                message_id = frame["message_id"]
+                queue = self.queues.get(message_id)
+                if queue:
+                    queue.put_nowait(expand_item(frame["item"], message_id, self.models[message_id]))
+            elif op in ("accepted", "error"):
+                if op == "accepted":
+                    self.queues[frame["message_id"]] = asyncio.Queue()
+                    self.models[frame["message_id"]] = frame.get("model", "astrbot-default-model")
+                future = self._accepting.pop(frame["rid"], None)
+                if future and not future.done():
+                    future.set_result(frame)
+                elif op == "accepted":
+                    # 客户端已离开，通知主进程清理
+                    self.queues.pop(frame["message_id"], None)
+                    self.models.pop(frame["message_id"], None)
+                    await self.send({"op": "done", "message_id": frame["message_id"]})
+
+    def check_auth(self, request: web.Request) -> tuple[web.Response | None, str]:
+        auth_header = request.headers.get("Authorization")
+        if not auth_header or not auth_header.startswith("Bearer "):
+            return web.json_response({"error": "Missing Authorization header"}, status=401), ""
+
+        token = auth_header.split(" ")[1]
+        api_key = self.config.get("api_key")
+        if api_key and token != api_key:
+            return web.json_response({"error": "Invalid API key"}, status=401), token
+        return None, token
+
+    async def handle_list_models(self, request: web.Request):
+        auth_error, _ = self.check_auth(request)
+        if auth_error:
+            return auth_error
+
+        return web.json_response({
+            "object": "list",
+            "data": [
+                {
+                    "id": "Astrbot",
+                    "object": "model",
+                    "created": int(time.time()),
+                    "owned_by": "astrbot"
+                }
+            ]
+        })
+
+    async def handle_chat_completions(self, request: web.Request):
+        auth_error, token = self.check_auth(request)
+        if auth_error:
+            return auth_error
+
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            return web.json_response({"error": "Invalid JSON body"}, status=400)
+        if not isinstance(body, dict):
+            return web.json_response({"error": "Invalid JSON body"}, status=400)
+
+        try:
+            compact = compact_request(body, message_digests if self.config.get("fingerprint") else None)
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+
+        is_stream = compact["stream"]
+        self._next_rid += 1
+        rid = self._next_rid
+        future = asyncio.get_running_loop().create_future()
+        self._accepting[rid] = future
+
+        try:
+            await self.send({
+                "op": "req",
+                "rid": rid,
+                "request": compact,
+                "api_key": token,
+            })
+            frame = await future
+        finally:
+            self._accepting.pop(rid, None)
+
+        if frame["op"] == "error":
+            return web.json_response({"error": frame["error"]}, status=frame.get("status", 400))
+
+        message_id = frame["message_id"]
+        queue = self.queues[message_id]
+        timeout = self.config["timeout"]
+        aggregation_timeout = self.config["aggregation_timeout"]
+
+        try:
+            if not is_stream:
+                payload, status = await collect_non_stream(queue, message_id, timeout, aggregation_timeout, logger)
+                return web.json_response(payload, status=status)
+
+            response = web.StreamResponse(
+                status=200,
+                reason="OK",
+                headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+            )
+            await response.prepare(request)
+            # 发送一个初始空块，让客户端知道连接已建立
+            queue.put_nowait(format_as_openai_chunk({}, message_id, frame.get("model", "astrbot-stream")))
+            try:
+                await pump_stream(queue, response.write, message_id, timeout, aggregation_timeout, logger)
+            finally:
+                await response.write_eof()
+            return response
+        finally:
+            self.queues.pop(message_id, None)
+            self.models.pop(message_id, None)
+            try:
+                await self.send({"op": "done", "message_id": message_id})
+            except Exception as e:
+                logger.warning(f"通知主进程请求结束失败: {e}")
+
+
+    async def handle_proxy(self, request: web.Request):
+        """ 把 worker 未实现的接口转发给主进程，请求体和响应体都以流的方式透传 (批量接口的 ndjson 可逐行返回) """
+        if self.proxy_session is None:
+            self.proxy_session = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(path=self.config["proxy_path"]),
+                timeout=aiohttp.ClientTimeout(total=None),
+                auto_decompress=False,
+            )
+
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        response = None
+        try:
+            async with self.proxy_session.request(
+                request.method,
+                f"http://chatbox{request.rel_url}",
+                headers=headers,
+                data=request.content if request.body_exists else None,
+                allow_redirects=False,
+            ) as upstream:
+                response = web.StreamResponse(
+                    status=upstream.status,
+                    reason=upstream.reason,
+                    headers={k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS},
+                )
+                await response.prepare(request)
+                async for chunk in upstream.content.iter_any():
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        except (aiohttp.ClientError, ConnectionError) as e:
+            logger.warning(f"转发 {request.method} {request.path} 失败: {e}")
+            if response is not None and response.prepared:
+                # 已经开始向客户端发送响应，只能直接结束
+                return response
+            return web.json_response({"error": "Upstream unavailable"}, status=502)
+
+
+async def serve(args):
+    worker = FrontendWorker(args.worker_id, args.ipc_path)
+    await worker.connect()
+
+    app = web.Application()
+    app.router.add_get("/v1/models", worker.handle_list_models)
+    app.router.add_post("/v1/chat/completions", worker.handle_chat_completions)
+    app.router.add_route("*", "/{tail:.*}", worker.handle_proxy)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, args.host, args.port, reuse_address=True, reuse_port=True)
+    await site.start()
+    logger.info(f"worker {args.worker_id} 已在 http://{args.host}:{args.port} 上监听")
+
+    try:
+        # 主进程断开 (AstrBot 退出或适配器停止) 时 worker 随之退出
+        await worker.read_loop()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        logger.info(f"worker {args.worker_id}: 与主进程的连接已断开，退出")
+    finally:
+        await runner.cleanup()
+        if worker.proxy_session:
+            await worker.proxy_session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chatbox 适配器 HTTP 前端 worker")
+    parser.add_argument("--host", required=True)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--ipc-path", required=True)
+    parser.add_argument("--worker-id", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=f"[chatbox-worker {args.worker_id}] %(levelname)s %(message)s")
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import uuid
 
 from astrbot.api import logger
 from astrbot.api.event import AstrMessageEvent, filter
-from astrbot.api.provider import LLMResponse
+from astrbot.api.provider import LLMResponse, ProviderRequest
 from astrbot.api.star import Context, Star, register
 
 try:
@@ -20,6 +20,11 @@ except Exception as e:
     logger.error(f"Chatbox 适配器加载失败: {e}")
     logger.exception(e)
 
+try:
+    from .chatbox_fingerprint import trim_dropped_turns
+except ImportError:
+    trim_dropped_turns = None
+
 try:
     from .chatbox_event import ChatboxEvent
 except ImportError:
@@ -41,6 +46,32 @@ class ChatboxPlugin(Star):
         if isinstance(event, ChatboxEvent):
             yield event.plain_result("pong (from chatbox adapter)")
 
+    @filter.on_llm_request(priority=100)
+    async def apply_history_rollback(self, event: AstrMessageEvent, req: ProviderRequest):
+        if not isinstance(event, ChatboxEvent) or trim_dropped_turns is None:
+            return
+
+        # 客户端重新生成/编辑了历史消息：把被丢弃的轮次从上下文中去掉，
+        # AstrBot 保存历史时基于 req.contexts，因此回滚也会持久化
+        if event.history_rollback and isinstance(req.contexts, list):
+            before = len(req.contexts)
+            req.contexts = trim_dropped_turns(req.contexts, event.history_rollback)
+            logger.debug(f"【Chatbox 钩子】: 已回滚 {len(event.history_rollback)} 轮对话历史 ({before} -> {len(req.contexts)} 条上下文)")
+            event.history_rollback = []
+
+    @filter.on_llm_response(priority=-100)
+    async def mark_persisted_turn(self, event: AstrMessageEvent, resp: LLMResponse):
+        # 在其它 on_llm_response 钩子之后运行：只有得到 assistant 回复且事件未被停止时，
+        # AstrBot 才会保存本轮对话，此时才能把它记为可回滚的轮次
+        if not isinstance(event, ChatboxEvent) or event.fingerprint_turn is None:
+            return
+
+        index = event.client.fingerprint_index
+        if not index or resp.role != "assistant" or event.is_stopped():
+            return
+
+        index.mark_llm_turn(event.message_obj.session_id, event.fingerprint_turn, event.message_str)
+
     @filter.on_llm_response(priority=100)
     async def intercept_tool_calls(self, event: AstrMessageEvent, resp: LLMResponse):
         if not isinstance(event, ChatboxEvent):
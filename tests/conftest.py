@@ -0,0 +1,18 @@
+import logging
+import os
+import sys
+import types
+
+# 插件目录不是一个可安装的包，测试直接按模块名导入不依赖 AstrBot 流水线的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import astrbot.api  # noqa: F401
+except ImportError:
+    # 纯逻辑模块只用到 astrbot.api.logger
+    _astrbot = types.ModuleType("astrbot")
+    _api = types.ModuleType("astrbot.api")
+    _api.logger = logging.getLogger("astrbot")
+    _astrbot.api = _api
+    sys.modules["astrbot"] = _astrbot
+    sys.modules["astrbot.api"] = _api
@@ -0,0 +1,107 @@
+from chatbox_fingerprint import ConversationFingerprintIndex, message_digests, trim_dropped_turns
+
+
+def user(text):
+    return {"role": "user", "content": text}
+
+
+def assistant(text):
+    return {"role": "assistant", "content": text}
+
+
+class Client:
+    """ 模拟 Chatbox：每轮发送最近 window 条消息 (None 为全部)，并像 on_llm_response 钩子一样标记已保存的轮次 """
+
+    def __init__(self, index, window=None, session="s"):
+        self.index = index
+        self.window = window
+        self.session = session
+        self.history = []
+
+    def send(self, messages, persist=True):
+        if self.window is not None:
+            messages = messages[-self.window:]
+        turn_index = max(i for i, m in enumerate(messages) if m["role"] == "user")
+        turn, dropped = self.index.observe(self.session, message_digests(messages), turn_index)
+        if persist:
+            self.index.mark_llm_turn(self.session, turn, messages[turn_index]["content"])
+        return dropped
+
+    def say(self, text, persist=True):
+        self.history.append(user(text))
+        dropped = self.send(self.history, persist)
+        self.history.append(assistant(f"re:{text}"))
+        return dropped
+
+
+def test_continue_does_not_roll_back():
+    client = Client(ConversationFingerprintIndex())
+    assert [client.say(f"q{i}") for i in range(4)] == [[], [], [], []]
+
+
+def test_regenerate_rolls_back_last_turn():
+    client = Client(ConversationFingerprintIndex())
+    client.say("q0")
+    client.say("q1")
+    # 重新生成：去掉最后一条 assistant 回复后原样重发
+    client.history.pop()
+    assert client.send(client.history) == ["q1"]
+
+
+def test_edit_rolls_back_from_edited_turn():
+    client = Client(ConversationFingerprintIndex())
+    for i in range(3):
+        client.say(f"q{i}")
+    # 编辑 q1：客户端丢弃 q1 之后的全部消息
+    assert client.send([user("q0"), assistant("re:q0"), user("q1 edited")]) == ["q1", "q2"]
+
+
+def test_sliding_window_continue_does_not_roll_back():
+    client = Client(ConversationFingerprintIndex(), window=3)
+    assert [client.say(f"q{i}") for i in range(6)] == [[]] * 6
+
+
+def test_sliding_window_regenerate_rolls_back_only_last_turn():
+    client = Client(ConversationFingerprintIndex(), window=3)
+    for i in range(5):
+        client.say(f"q{i}")
+    client.history.pop()
+    assert client.send(client.history) == ["q4"]
+    # 重新生成后的轮次保存后，继续对话仍然不回滚
+    client.history.append(assistant("re:q4 again"))
+    assert client.say("q5") == []
+
+
+def test_repeated_messages_continue():
+    client = Client(ConversationFingerprintIndex(), window=4)
+    assert [client.say("continue") for _ in range(5)] == [[]] * 5
+
+
+def test_unsaved_turn_is_not_rolled_back():
+    client = Client(ConversationFingerprintIndex())
+    client.say("q0")
+    client.say("tool call", persist=False)
+    client.history.pop()
+    assert client.send(client.history) == []
+
+
+def test_unaligned_request_does_not_roll_back():
+    # 上下文条数上限为 0：每次只发送最新一条消息
+    client = Client(ConversationFingerprintIndex(), window=1)
+    assert [client.say(f"q{i}") for i in range(3)] == [[], [], []]
+
+
+def test_trim_dropped_turns_matches_content():
+    contexts = [user("q0"), assistant("a0"), user("q1"), assistant("a1"), user("q2"), assistant("a2")]
+    assert trim_dropped_turns(contexts, ["q1", "q2"]) == contexts[:2]
+    assert trim_dropped_turns(contexts, ["missing"]) == contexts
+
+
+def test_trim_dropped_turns_skips_later_identical_turns():
+    contexts = [user("go"), assistant("1"), user("go"), assistant("2"), user("go"), assistant("3")]
+    assert trim_dropped_turns(contexts, ["go", "go"]) == contexts[:2]
+
+
+def test_trim_dropped_turns_multimodal_content():
+    contexts = [user("q0"), assistant("a0"), {"role": "user", "content": [{"type": "text", "text": "look"}]}, assistant("a1")]
+    assert trim_dropped_turns(contexts, ["look"]) == contexts[:2]
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from chatbox_protocol import UploadTooLarge, iter_jsonl_lines
+
+
+def split(chunks, max_line=10, max_upload=1000):
+    async def _chunks():
+        for chunk in chunks:
+            yield chunk
+
+    async def _collect():
+        return [item async for item in iter_jsonl_lines(_chunks(), max_line, max_upload)]
+
+    return asyncio.run(_collect())
+
+
+def test_lines_split_across_chunks():
+    assert split([b"ab", b"c\nde", b"f\n", b"gh"]) == [(1, b"abc"), (2, b"def"), (3, b"gh")]
+
+
+def test_blank_lines_keep_line_numbers():
+    assert split([b"a\n\nb\n"]) == [(1, b"a"), (2, b""), (3, b"b")]
+
+
+def test_oversize_line_in_single_chunk():
+    assert split([b"short\n" + b"x" * 11 + b"\nnext\n"]) == [(1, b"short"), (2, None), (3, b"next")]
+
+
+def test_oversize_line_across_chunk_boundaries():
+    # 超长行分散在多个块中：只报告一次，剩余部分被丢弃，下一行照常解析
+    chunks = [b"ok\n" + b"x" * 8, b"x" * 8, b"x" * 8, b"x\nnext\n"]
+    assert split(chunks) == [(1, b"ok"), (2, None), (3, b"next")]
+
+
+def test_oversize_line_ending_exactly_at_chunk_boundary():
+    assert split([b"x" * 11, b"\n", b"next"]) == [(1, None), (2, b"next")]
+
+
+def test_oversize_last_line_without_newline():
+    assert split([b"ok\n", b"x" * 20]) == [(1, b"ok"), (2, None)]
+
+
+def test_line_at_limit_across_boundary_is_kept():
+    assert split([b"x" * 6, b"x" * 4 + b"\n"]) == [(1, b"x" * 10)]
+
+
+def test_upload_limit():
+    with pytest.raises(UploadTooLarge):
+        split([b"a\n" * 10, b"b\n" * 10], max_upload=30)
+
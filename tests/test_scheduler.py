@@ -0,0 +1,91 @@
+from chatbox_scheduler import EventScheduler, Lane
+
+
+def make_scheduler(lanes, default_lane=None, max_inflight=0):
+    committed = []
+    scheduler = EventScheduler(lanes, default_lane or Lane("default"), max_inflight, committed.append)
+    return scheduler, committed
+
+
+def test_classify_by_prefix_api_key_and_user():
+    commands = Lane("commands", command_prefixes=["/"])
+    batch = Lane("batch", api_keys=["eval"])
+    vip = Lane("vip", user_ids=[42])
+    scheduler, _ = make_scheduler([commands, batch, vip])
+    assert scheduler.classify("  /ping", "eval", "1") is commands
+    assert scheduler.classify("hello", "eval", "1") is batch
+    assert scheduler.classify("hello", None, "42") is vip
+    assert scheduler.classify("hello", None, "1") is scheduler.default_lane
+
+
+def test_weighted_dequeue():
+    heavy = Lane("heavy", weight=3, api_keys=["h"])
+    light = Lane("light", weight=1, api_keys=["l"])
+    scheduler, committed = make_scheduler([heavy, light], max_inflight=1)
+    for i in range(8):
+        scheduler.submit(f"h{i}", f"h{i}", heavy)
+        scheduler.submit(f"l{i}", f"l{i}", light)
+
+    # 每次只放行一个请求，结束后按权重选下一个
+    while len(committed) < 8:
+        scheduler.release(committed[-1])
+    assert sum(e.startswith("h") for e in committed) == 6
+    assert sum(e.startswith("l") for e in committed) == 2
+
+
+def test_idle_lane_does_not_bank_credit():
+    busy = Lane("busy", api_keys=["b"])
+    idle = Lane("idle", api_keys=["i"])
+    scheduler, committed = make_scheduler([busy, idle], max_inflight=1)
+    for i in range(6):
+        scheduler.submit(f"b{i}", f"b{i}", busy)
+    for _ in range(4):
+        scheduler.release(committed[-1])
+    # idle 通道空闲期间不累积额度，加入后与 busy 交替出队，而不是连续插队
+    for i in range(3):
+        scheduler.submit(f"i{i}", f"i{i}", idle)
+    for _ in range(3):
+        scheduler.release(committed[-1])
+    assert committed[5:] == ["i0", "b5", "i1"]
+
+
+def test_lane_cap_is_released_on_finish():
+    capped = Lane("capped", max_concurrency=2, api_keys=["c"])
+    scheduler, committed = make_scheduler([capped])
+    for i in range(4):
+        scheduler.submit(f"c{i}", f"c{i}", capped)
+    assert committed == ["c0", "c1"]
+    assert capped.inflight == 2
+
+    scheduler.release("c0")
+    assert committed == ["c0", "c1", "c2"]
+    scheduler.release("c1")
+    scheduler.release("c2")
+    scheduler.release("c3")
+    assert committed == ["c0", "c1", "c2", "c3"]
+    assert capped.inflight == 0 and scheduler.inflight == 0
+
+
+def test_capped_lane_does_not_block_other_lanes():
+    capped = Lane("capped", max_concurrency=1, api_keys=["c"])
+    scheduler, committed = make_scheduler([capped])
+    scheduler.submit("c0", "c0", capped)
+    scheduler.submit("c1", "c1", capped)
+    scheduler.submit("d0", "d0", scheduler.default_lane)
+    assert committed == ["c0", "d0"]
+
+
+def test_release_of_queued_request_drops_it():
+    lane = Lane("lane", max_concurrency=1, api_keys=["x"])
+    scheduler, committed = make_scheduler([lane])
+    scheduler.submit("a", "a", lane)
+    scheduler.submit("b", "b", lane)
+    scheduler.submit("c", "c", lane)
+    # b 在排队时超时，c 应在 a 结束后直接出队
+    scheduler.release("b")
+    assert lane.inflight == 1
+    scheduler.release("a")
+    assert committed == ["a", "c"]
+    # 重复 release 不会让计数变为负数
+    scheduler.release("a")
+    assert lane.inflight == 1 and scheduler.inflight == 1